@@ -0,0 +1,76 @@
+# The sections of a notification email, in the order digests list them.
+DIGEST_SECTIONS = (
+    'bill_action_updates',
+    'bill_search_updates',
+    'person_updates',
+    'committee_action_updates',
+    'committee_event_updates',
+    'updated_events',
+    'new_events',
+)
+
+EMPTY = ()
+
+
+class Digest(object):
+    # What one user is sent. A new one is made for every user, so nothing
+    # carries over from the last. Empty sections share one empty tuple.
+    #
+    # A digest queued with --shared-payload has no sections of its own, just
+    # the run and the keys its updates are stored under until load_digest
+    # fills them in. delivery is the (run ID, content hash) pair the
+    # delivery ledger knows it by.
+
+    __slots__ = ('user_id', 'user_email', 'run_id', 'update_keys', 'delivery') + DIGEST_SECTIONS
+
+    def __init__(self, user_id, user_email, run_id=None, update_keys=None, delivery=None, **sections):
+        self.user_id = user_id
+        self.user_email = user_email
+        self.run_id = run_id
+        self.update_keys = update_keys
+        self.delivery = delivery
+
+        for section in DIGEST_SECTIONS:
+            setattr(self, section, sections.pop(section, None) or EMPTY)
+
+        if sections:
+            raise TypeError('Unknown digest sections: {}'.format(', '.join(sorted(sections))))
+
+    @classmethod
+    def from_job(cls, digest):
+        # Jobs queued before digests were objects carry them as dicts.
+        if isinstance(digest, cls):
+            return digest
+
+        return cls(**digest)
+
+    @property
+    def filled_sections(self):
+        return tuple(s for s in DIGEST_SECTIONS if getattr(self, s))
+
+    def __bool__(self):
+        return bool(self.filled_sections or self.update_keys)
+
+    def sections(self):
+        return {s: getattr(self, s) for s in DIGEST_SECTIONS}
+
+    def section_counts(self):
+        return {s: len(getattr(self, s)) for s in DIGEST_SECTIONS}
+
+    # Pickled by name, so jobs queued before a slot is added, removed or
+    # moved still load: slots they lack get their defaults, and ones this
+    # version no longer has are dropped.
+
+    def __getstate__(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # Queued when digests pickled as a tuple in slot order.
+            state = dict(zip(self.__slots__, state))
+
+        self.__init__(None, None)
+
+        for attr, value in state.items():
+            if attr in self.__slots__:
+                setattr(self, attr, value)
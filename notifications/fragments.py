@@ -0,0 +1,180 @@
+import hashlib
+import json
+
+import django_rq
+
+from django.conf import settings
+from django.template import Context
+from django.template.base import Node
+from django.template.defaulttags import ForNode, IfNode
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from notifications.results import json_default
+
+# The loops in the notification email templates that render one block per
+# update. Each block is cached under the template's source, the rest of the
+# context (SITE_META and CITY_VOCAB) and the content of its update, so a
+# block shared by many recipients is rendered once, and each email is the
+# rest of its template with the cached blocks joined in. Since a loop's
+# output is just the output of its body for each item in turn, the result is
+# the same as rendering the whole template.
+SECTIONS = (
+    'person_updates',
+    'committee_action_updates',
+    'committee_event_updates',
+    'bill_search_updates',
+    'bill_action_updates',
+    'new_events',
+    'updated_events',
+)
+
+cache_fragments = getattr(settings, 'NOTIFICATIONS_CACHE_FRAGMENTS', True)
+fragment_ttl = getattr(settings, 'NOTIFICATIONS_FRAGMENT_TTL', 60 * 60 * 24)
+
+_templates = {}
+
+
+class FragmentCache(object):
+
+    def __init__(self, template, context):
+        # Blocks are only reused while the template and everything else they
+        # could show stay the same, so an edited template, changed settings
+        # or another site sharing the same Redis never gets them.
+        shared_context = {k: v for k, v in context.items() if k not in SECTIONS}
+
+        self.base = hashlib.sha1(template.source.encode('utf-8'))
+        self.base.update(json.dumps(shared_context, sort_keys=True, default=str).encode('utf-8'))
+
+        self.keys = {}
+        self.blocks = {}
+        self.rendered = {}
+
+    def key(self, section, item):
+        try:
+            return self.keys[id(item)]
+        except KeyError:
+            digest = self.base.copy()
+            digest.update(section.encode('utf-8'))
+            # Serialized with sorted keys, so that every worker process,
+            # whatever its hash seed and so its dict order, gets the same key.
+            digest.update(json.dumps(item, sort_keys=True, default=json_default).encode('utf-8'))
+
+            key = self.keys[id(item)] = 'notifications:fragment:{}'.format(digest.hexdigest())
+
+            return key
+
+    def prefetch(self, context):
+        keys = [self.key(section, item)
+                for section in SECTIONS
+                for item in context.get(section) or []]
+
+        if keys:
+            redis = django_rq.get_connection()
+
+            for key, block in zip(keys, redis.mget(keys)):
+                if block is not None:
+                    self.blocks[key] = block.decode('utf-8')
+
+    def get(self, key):
+        return self.blocks.get(key)
+
+    def set(self, key, block):
+        self.blocks[key] = self.rendered[key] = block
+
+    def save(self):
+        if self.rendered:
+            pipeline = django_rq.get_connection().pipeline()
+
+            for key, block in self.rendered.items():
+                pipeline.set(key, block.encode('utf-8'), ex=fragment_ttl)
+
+            pipeline.execute()
+
+
+class CachedForNode(Node):
+
+    def __init__(self, for_node):
+        self.for_node = for_node
+        self.token = getattr(for_node, 'token', None)
+
+    def render(self, context):
+        fragments = context.get('notification_fragments')
+        section = self.for_node.sequence.token
+
+        try:
+            items = context[section]
+        except KeyError:
+            items = None
+
+        if fragments is None or not items:
+            return self.for_node.render(context)
+
+        blocks = []
+
+        for item in items:
+            key = fragments.key(section, item)
+            block = fragments.get(key)
+
+            if block is None:
+                # Rendering the loop over just this item gives exactly the
+                # block the loop renders for it.
+                with context.push(**{section: [item]}):
+                    block = self.for_node.render(context)
+
+                fragments.set(key, block)
+
+            blocks.append(block)
+
+        return mark_safe(''.join(blocks))
+
+
+def wrap_sections(nodelist):
+    for i, node in enumerate(nodelist):
+
+        if isinstance(node, ForNode) and node.sequence.token in SECTIONS:
+            nodelist[i] = CachedForNode(node)
+
+        elif isinstance(node, IfNode):
+            for condition, child_nodelist in node.conditions_nodelists:
+                wrap_sections(child_nodelist)
+
+        else:
+            for attr in node.child_nodelists:
+                child_nodelist = getattr(node, attr, None)
+
+                if child_nodelist:
+                    wrap_sections(child_nodelist)
+
+
+def get_notification_template(template_name):
+    try:
+        return _templates[template_name]
+    except KeyError:
+        # Compile a private copy, so the templates used elsewhere are left
+        # alone.
+        template = get_template(template_name).template
+        template = template.engine.from_string(template.source)
+
+        wrap_sections(template.nodelist)
+
+        _templates[template_name] = template
+
+        return template
+
+
+def render_notification(template_name, context):
+
+    if not cache_fragments:
+        return get_template(template_name).render(context)
+
+    template = get_notification_template(template_name)
+
+    fragments = FragmentCache(template, context)
+    fragments.prefetch(context)
+
+    content = template.render(Context(dict(context, notification_fragments=fragments)))
+
+    fragments.save()
+
+    return content
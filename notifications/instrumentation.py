@@ -0,0 +1,174 @@
+import math
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+# Timing for the stages of sending notifications: each finder, each Solr
+# request, and rendering and sending each email. The default does nothing.
+# Set NOTIFICATIONS_INSTRUMENTATION to the dotted path of a subclass of
+# RecordingInstrumentation to keep timings, and override observe() there to
+# export them as they happen, e.g. to StatsD. Stages run in RQ workers are
+# only ever seen by observe(), since the summary belongs to the command.
+
+_instrumentation = None
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+class Instrumentation(object):
+
+    recording = False
+
+    def timer(self, stage):
+        return NULL_TIMER
+
+    def observe(self, stage, seconds, queries=None):
+        pass
+
+    def for_shard(self):
+        return self
+
+    def merge(self, shard_instrumentation):
+        pass
+
+    def summary(self):
+        return {}
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Timer(object):
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.queries = self.instrumentation.query_count()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        queries = self.instrumentation.query_count() - self.queries
+
+        self.instrumentation.observe(self.stage, seconds, queries)
+
+        return False
+
+
+class RecordingInstrumentation(Instrumentation):
+
+    recording = True
+
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.queries_seen = 0
+        self.last_query = None
+        self.force_debug_cursor = None
+
+    def query_count(self):
+        # Counts the queries logged since the last one seen, leaving the log
+        # alone for anything else reading it. The log is bounded, so
+        # queries are found from the end rather than by position.
+        queries_log = connection.queries_log
+
+        for query in reversed(queries_log):
+            if query is self.last_query:
+                break
+
+            self.queries_seen += 1
+
+        if queries_log:
+            self.last_query = queries_log[-1]
+
+        return self.queries_seen
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def observe(self, stage, seconds, queries=None):
+        self.seconds[stage].append(seconds)
+
+        if queries:
+            self.queries[stage] += queries
+
+    def for_shard(self):
+        # Timings made in another process have to be handed back and merged,
+        # so a shard starts from empty ones.
+        return self.__class__()
+
+    def merge(self, shard_instrumentation):
+        for stage, seconds in shard_instrumentation.seconds.items():
+            self.seconds[stage].extend(seconds)
+
+        for stage, queries in shard_instrumentation.queries.items():
+            self.queries[stage] += queries
+
+    def summary(self):
+        summary = {}
+
+        for stage, seconds in self.seconds.items():
+            seconds = sorted(seconds)
+
+            summary[stage] = {
+                'count': len(seconds),
+                'total_seconds': sum(seconds),
+                'p50': percentile(seconds, 50),
+                'p95': percentile(seconds, 95),
+                'p99': percentile(seconds, 99),
+                'queries': self.queries[stage],
+            }
+
+        return summary
+
+    def start(self):
+        # Django only logs queries with a debug cursor, so one is used from
+        # here until close(), and not by instances that are never started,
+        # such as the one get_instrumentation() makes. Shards use the
+        # connection of the run that started, and are not started themselves.
+        self.force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+
+    def close(self):
+        if self.force_debug_cursor is not None:
+            connection.force_debug_cursor = self.force_debug_cursor
+            self.force_debug_cursor = None
+
+
+def percentile(sorted_values, p):
+    # Nearest rank.
+    if not sorted_values:
+        return None
+
+    rank = max(int(math.ceil(p / 100.0 * len(sorted_values))), 1)
+
+    return sorted_values[rank - 1]
+
+
+def get_instrumentation():
+    global _instrumentation
+
+    if _instrumentation is None:
+        path = getattr(settings, 'NOTIFICATIONS_INSTRUMENTATION',
+                       'notifications.instrumentation.Instrumentation')
+        _instrumentation = import_string(path)()
+
+    return _instrumentation
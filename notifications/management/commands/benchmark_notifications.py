@@ -0,0 +1,709 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import json
+import pickle
+import random
+import resource
+import subprocess
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from io import StringIO
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+
+from django.db import transaction, connection
+from django.db.models import Max
+
+from django.contrib.auth.models import User
+
+from councilmatic_core.models import Bill, Organization, Person
+
+from notifications.models import PersonSubscription, BillActionSubscription, \
+    CommitteeActionSubscription, CommitteeEventSubscription, \
+    BillSearchSubscription, EventsSubscription, SUBSCRIBER_INDEX, index_subscribers
+from notifications.utils import search_hash
+from notifications import fragments
+
+from notifications.management.commands import send_notifications
+from notifications.management.commands.send_notifications import SUBSCRIBED_USERS, \
+    Command as SendNotificationsCommand, digest_email
+
+# The subscribed users query as it was before each subscription type was
+# aggregated separately. Kept here so the two plans can be compared.
+JOIN_FANOUT_QUERY = '''
+    SELECT
+      u.id AS user_id,
+      MAX(u.email) as user_email,
+      array_agg(DISTINCT bas.bill_id) AS bill_action_ids,
+      array_agg(DISTINCT bss.search_params) AS bill_search_params,
+      array_agg(DISTINCT cas.committee_id) AS committee_action_ids,
+      array_agg(DISTINCT ces.committee_id) AS committee_event_ids,
+      array_agg(DISTINCT ps.person_id) as person_ids,
+      bool_and(es.id::bool) AS event_subscription
+    FROM auth_user AS u
+    LEFT JOIN notifications_billactionsubscription AS bas
+      ON u.id = bas.user_id
+    LEFT JOIN notifications_billsearchsubscription AS bss
+      ON u.id = bss.user_id
+    LEFT JOIN notifications_committeeactionsubscription AS cas
+      ON u.id = cas.user_id
+    LEFT JOIN notifications_committeeeventsubscription AS ces
+      ON u.id = ces.user_id
+    LEFT JOIN notifications_personsubscription AS ps
+      ON u.id = ps.user_id
+    LEFT JOIN notifications_eventssubscription AS es
+      ON u.id = es.user_id
+    WHERE (bas.bill_id IS NOT NULL
+           OR bss.search_params IS NOT NULL
+           OR cas.committee_id IS NOT NULL
+           OR ces.committee_id IS NOT NULL
+           OR ps.person_id IS NOT NULL
+           OR es.id IS NOT NULL)
+    GROUP BY u.id
+'''
+
+SEARCH_TERMS = ['zoning', 'budget', 'police', 'housing', 'parking', 'tax', '']
+
+# Copies existing rows of a councilmatic table round robin, replacing the
+# given columns with SQL expressions of the row number i. Synthetic data
+# made this way looks like the real thing without this command having to
+# know every column of the councilmatic schema.
+CLONE_ROWS = '''
+    INSERT INTO {table} ({columns})
+    SELECT {values}
+    FROM generate_series(0, %(count)s - 1) AS i
+    JOIN (
+      SELECT *, row_number() OVER () - 1 AS template
+      FROM {table}
+    ) AS src
+      ON src.template = i %% (SELECT count(*) FROM {table})
+'''
+
+SYNTHETIC_BILL = "'ocd-bill/benchmark-' || {}"
+SYNTHETIC_EVENT = "'ocd-event/benchmark-' || {}"
+
+
+class Rollback(Exception):
+    pass
+
+
+class DryRunCommand(SendNotificationsCommand):
+    # Builds digests and renders and sends them in place of queueing them,
+    # so the whole pipeline can be timed without a worker or a mail server.
+    # Emails go to the locmem backend's outbox, which is emptied after each
+    # batch. What would have been queued is pickled, as RQ would, to measure
+    # it.
+
+    def start_run(self, options, run_id=None):
+        super().start_run(options, run_id)
+        self.digest_bytes = []
+        self.mail_connection = mail.get_connection('django.core.mail.backends.locmem.EmailBackend')
+
+    def queue_digests(self, results, digests, sections, user_ids):
+        for digest in digests:
+            self.digest_bytes.append(len(pickle.dumps(digest)))
+
+            with results.instrumentation.timer('render'):
+                msg = digest_email(digest)
+
+            with results.instrumentation.timer('send'):
+                self.mail_connection.send_messages([msg])
+
+        del mail.outbox[:]
+
+        results.record_users(sections, {})
+        return 0
+
+
+class SolrStandIn(BaseHTTPRequestHandler):
+    # Answers the searches send_notifications makes. Each term matches a
+    # fixed tenth of the bills it is asked about, so runs are repeatable.
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode('utf-8'))
+
+        term = params['q'][0]
+        bill_ids = params['fq'][0].split('}', 1)[1].split(',')
+
+        docs = [{'ocd_id': bill_id} for bill_id in bill_ids
+                if zlib.crc32((term + bill_id).encode('utf-8')) % 10 == 0]
+
+        time.sleep(self.server.latency)
+
+        body = json.dumps({'response': {'numFound': len(docs), 'docs': docs}}).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SolrStandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark the notification queries against seeded subscribers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode',
+            choices=['plans', 'memory', 'pipeline'],
+            default='plans',
+            help='Compare the subscribed users query plans, the memory used to stream subscribers, or time building digests from synthetic data.'
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=50000,
+            help='Number of synthetic subscribers to seed.'
+        )
+        parser.add_argument(
+            '--scales',
+            default='1000,10000,100000',
+            help='Comma separated subscriber counts to measure memory or time the pipeline at.'
+        )
+        parser.add_argument(
+            '--fetch-size',
+            type=int,
+            default=2000,
+            help='Number of subscribers fetched at a time by the server-side cursor.'
+        )
+        parser.add_argument(
+            '--skew',
+            type=float,
+            default=1.5,
+            help='Pareto shape for subscription counts per user. Lower is more skewed.'
+        )
+        parser.add_argument(
+            '--zipf',
+            type=float,
+            default=1.0,
+            help='Zipf exponent for how popular each followed entity is. 0 makes them equally popular.'
+        )
+        parser.add_argument(
+            '--max-subscriptions',
+            type=int,
+            default=50,
+            help='Upper bound on subscriptions of one type per user.'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of times to run each query.'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed, so runs can be compared.'
+        )
+        parser.add_argument(
+            '--bills',
+            type=int,
+            default=5000,
+            help='Number of synthetic bills to add for the pipeline benchmark, with actions and sponsorships.'
+        )
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=500,
+            help='Number of synthetic upcoming events to add for the pipeline benchmark.'
+        )
+        parser.add_argument(
+            '--changed-fraction',
+            type=float,
+            default=0.2,
+            help='Share of the synthetic bills and events that count as changed by the last import.'
+        )
+        parser.add_argument(
+            '--solr-latency',
+            type=float,
+            default=0.005,
+            help='Seconds the Solr stand-in takes to answer each search.'
+        )
+        parser.add_argument(
+            '--fragment-cache',
+            action='store_true',
+            default=False,
+            help='Render the pipeline benchmark\'s emails with the fragment cache, which needs Redis.'
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='File to write the results to, as well as stdout.'
+        )
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.cum_weights = {}
+
+        bill_ids = list(Bill.objects.values_list('ocd_id', flat=True))
+        person_ids = list(Person.objects.values_list('ocd_id', flat=True))
+        committee_ids = list(Organization.objects.values_list('ocd_id', flat=True))
+
+        if not (bill_ids and person_ids and committee_ids):
+            raise CommandError('Load some bills, people and committees before benchmarking')
+
+        # Synthetic data is cloned from what is loaded, so results are only
+        # comparable between databases with the same amount of it.
+        self.source_rows = {
+            'councilmatic_core_bill': len(bill_ids),
+            'councilmatic_core_person': len(person_ids),
+            'councilmatic_core_organization': len(committee_ids),
+        }
+
+        # Everything is seeded inside a transaction that is rolled back at the
+        # end, so the benchmark leaves the database as it found it.
+        try:
+            with transaction.atomic():
+                if options['mode'] == 'memory':
+                    results = self.benchmark_memory(options, bill_ids, person_ids, committee_ids)
+                elif options['mode'] == 'pipeline':
+                    results = self.benchmark_pipeline(options, person_ids, committee_ids)
+                else:
+                    results = self.benchmark_plans(options, bill_ids, person_ids, committee_ids)
+
+                raise Rollback
+        except Rollback:
+            pass
+
+        results['commit'] = current_commit()
+        results['source_rows'] = self.source_rows
+        results['options'] = {k: options[k] for k in ('mode', 'users', 'scales', 'fetch_size', 'skew',
+                                                      'zipf', 'max_subscriptions', 'repeat', 'seed',
+                                                      'bills', 'events', 'changed_fraction', 'solr_latency',
+                                                      'fragment_cache')}
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        self.stdout.write(output)
+
+    def benchmark_plans(self, options, bill_ids, person_ids, committee_ids):
+        self.seed_subscriptions(options, options['users'], 0, bill_ids, person_ids, committee_ids)
+
+        return {
+            'users': options['users'],
+            'skew': options['skew'],
+            'plans': {
+                'join_fanout': self.time_query(JOIN_FANOUT_QUERY, options['repeat']),
+                'per_type_aggregate': self.time_query(SUBSCRIBED_USERS.format(user_filter='TRUE'),
+                                                      options['repeat']),
+            }
+        }
+
+    def benchmark_memory(self, options, bill_ids, person_ids, committee_ids):
+        # Resident memory used to walk every subscriber, with a client-side
+        # cursor that loads all rows at once and with the server-side cursor
+        # send_notifications uses, as the number of subscribers grows.
+
+        scales = sorted(int(s) for s in options['scales'].split(','))
+
+        results = {
+            'skew': options['skew'],
+            'fetch_size': options['fetch_size'],
+            'scales': [],
+        }
+
+        seeded = 0
+
+        for scale in scales:
+            self.seed_subscriptions(options, scale - seeded, seeded, bill_ids, person_ids, committee_ids)
+            seeded = scale
+
+            # The server-side cursor goes first, so it cannot benefit from
+            # memory the client-side cursor leaves allocated.
+            server_rss = self.measure_rss(self.iterate_server_cursor, options['fetch_size'])
+            client_rss = self.measure_rss(self.iterate_client_cursor)
+
+            results['scales'].append({
+                'users': scale,
+                'server_cursor_rss_bytes': server_rss,
+                'client_cursor_rss_bytes': client_rss,
+            })
+
+        return results
+
+    def benchmark_pipeline(self, options, person_ids, committee_ids):
+        # Time to build, render and send every digest, and each stage along
+        # the way, as the number of subscribers grows, against synthetic
+        # bills, actions, sponsorships and events and a Solr stand-in.
+
+        scales = sorted(int(s) for s in options['scales'].split(','))
+
+        bill_ids = self.seed_councilmatic(options)
+
+        solr = SolrStandInServer(('127.0.0.1', 0), SolrStandIn)
+        solr.latency = options['solr_latency']
+        threading.Thread(target=solr.serve_forever, daemon=True).start()
+
+        haystack_url = send_notifications.haystack_url
+        send_notifications.haystack_url = 'http://127.0.0.1:{}/solr'.format(solr.server_address[1])
+
+        cache_fragments = fragments.cache_fragments
+        fragments.cache_fragments = options['fragment_cache']
+
+        results = {
+            'skew': options['skew'],
+            'zipf': options['zipf'],
+            'scales': [],
+        }
+
+        seeded = 0
+
+        try:
+            for scale in scales:
+                self.seed_subscriptions(options, scale - seeded, seeded, bill_ids, person_ids, committee_ids)
+                seeded = scale
+
+                runs = [self.time_pipeline(options) for _ in range(options['repeat'])]
+                best = min(runs, key=lambda r: r['seconds'])
+
+                results['scales'].append(dict(best,
+                                              users=scale,
+                                              mean_seconds=sum(r['seconds'] for r in runs) / len(runs),
+                                              peak_traced_bytes=self.trace_pipeline(options)))
+
+        finally:
+            send_notifications.haystack_url = haystack_url
+            fragments.cache_fragments = cache_fragments
+            solr.shutdown()
+
+        return results
+
+    def trace_pipeline(self, options):
+        # Peak memory Python allocates while building and rendering digests,
+        # from a run of its own since tracing slows everything down.
+
+        tracemalloc.start()
+
+        try:
+            self.time_pipeline(options)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return peak
+
+    def time_pipeline(self, options):
+        command = DryRunCommand(stdout=StringIO())
+
+        run_options = {
+            'users': 'all',
+            'batch': True,
+            'shared_payload': False,
+            'workers': 1,
+            'fetch_size': options['fetch_size'],
+            'incremental': False,
+            'run_id': None,
+            'results_jsonl': None,
+            'instrument': True,
+        }
+
+        start = time.perf_counter()
+
+        command.start_run(run_options)
+        command.start_cohort(None)
+        stats, last_user_id, output, shard_results = command.send_shard()
+
+        seconds = time.perf_counter() - start
+
+        command.results.merge(shard_results)
+
+        command.instrumentation.close()
+
+        digest_bytes = command.digest_bytes
+
+        return {
+            'seconds': seconds,
+            'digests': stats['digests'],
+            'digest_bytes': {
+                'total': sum(digest_bytes),
+                'mean': sum(digest_bytes) / len(digest_bytes) if digest_bytes else None,
+                'max': max(digest_bytes) if digest_bytes else None,
+            },
+            'stages': command.instrumentation.summary(),
+        }
+
+    def seed_councilmatic(self, options):
+        # Adds synthetic bills with actions and sponsorships, and upcoming
+        # events, copied from the ones already loaded. A share of them is put
+        # in temporary staging tables, which hide the ones left by the last
+        # import until the benchmark's transaction is rolled back. Returns
+        # the synthetic bill IDs.
+
+        bills = options['bills']
+        events = options['events']
+
+        for table in ('councilmatic_core_bill', 'councilmatic_core_action',
+                      'councilmatic_core_sponsorship', 'councilmatic_core_event',
+                      'councilmatic_core_eventparticipant'):
+            self.source_rows[table] = self.count_rows(table)
+
+            if not self.source_rows[table]:
+                raise CommandError('Load some data into {} before benchmarking the pipeline'.format(table))
+
+        self.clone_rows('councilmatic_core_bill', bills, {
+            'ocd_id': SYNTHETIC_BILL.format('i'),
+            'slug': "'benchmark-bill-' || i",
+            'identifier': "'BENCH ' || i",
+            'ocd_created_at': 'now()',
+            'updated_at': 'now()',
+        })
+        self.clone_rows('councilmatic_core_action', bills * 3, {
+            'bill_id': SYNTHETIC_BILL.format('i % {}'.format(bills)),
+            'order': 'i / {}'.format(bills),
+            'date': 'now()',
+            'updated_at': 'now()',
+        })
+        self.clone_rows('councilmatic_core_sponsorship', bills * 2, {
+            'bill_id': SYNTHETIC_BILL.format('i % {}'.format(bills)),
+            'updated_at': 'now()',
+        })
+        self.clone_rows('councilmatic_core_event', events, {
+            'ocd_id': SYNTHETIC_EVENT.format('i'),
+            'slug': "'benchmark-event-' || i",
+            'start_time': "now() + (i % 60 + 1) * interval '1 day'",
+            'ocd_created_at': 'now()',
+            'updated_at': 'now()',
+        })
+        self.clone_rows('councilmatic_core_eventparticipant', events * 2, {
+            'event_id': SYNTHETIC_EVENT.format('i % {}'.format(events)),
+        })
+
+        changed_bills = int(bills * options['changed_fraction'])
+        changed_events = int(events * options['changed_fraction'])
+
+        cursor = connection.cursor()
+
+        cursor.execute('''
+            CREATE TEMPORARY TABLE new_bill ON COMMIT DROP AS
+            SELECT {} AS ocd_id FROM generate_series(0, %(bills)s - 1) AS i
+        '''.format(SYNTHETIC_BILL.format('i')), {'bills': changed_bills})
+        cursor.execute('''
+            CREATE TEMPORARY TABLE new_action ON COMMIT DROP AS
+            SELECT ocd_id AS bill_id FROM new_bill
+        ''')
+        cursor.execute('''
+            CREATE TEMPORARY TABLE new_sponsorship ON COMMIT DROP AS
+            SELECT bill_id, person_id
+            FROM councilmatic_core_sponsorship
+            WHERE bill_id IN (SELECT ocd_id FROM new_bill)
+        ''')
+        cursor.execute('''
+            CREATE TEMPORARY TABLE new_event ON COMMIT DROP AS
+            SELECT {} AS ocd_id FROM generate_series(0, %(events)s - 1) AS i
+        '''.format(SYNTHETIC_EVENT.format('i')), {'events': changed_events // 2})
+        cursor.execute('''
+            CREATE TEMPORARY TABLE change_event ON COMMIT DROP AS
+            SELECT {} AS ocd_id FROM generate_series(%(start)s, %(events)s - 1) AS i
+        '''.format(SYNTHETIC_EVENT.format('i')), {'start': changed_events // 2, 'events': changed_events})
+        cursor.execute('ANALYZE')
+
+        self.stdout.write('Seeded {0} bills and {1} events'.format(bills, events))
+
+        return ['ocd-bill/benchmark-{}'.format(i) for i in range(bills)]
+
+    def clone_rows(self, table, count, overrides):
+        cursor = connection.cursor()
+
+        # Primary keys named id are serial, and left to the database.
+        columns = [c.name for c in connection.introspection.get_table_description(cursor, table)
+                   if c.name != 'id']
+
+        quote = connection.ops.quote_name
+
+        cursor.execute(CLONE_ROWS.format(table=table,
+                                         columns=', '.join(quote(c) for c in columns),
+                                         values=', '.join(overrides.get(c, 'src.{}'.format(quote(c)))
+                                                          for c in columns)),
+                       {'count': count})
+
+    def count_rows(self, table):
+        cursor = connection.cursor()
+        cursor.execute('SELECT count(*) FROM {}'.format(table))
+        return cursor.fetchone()[0]
+
+    def iterate_client_cursor(self, sample):
+        cursor = connection.cursor()
+        cursor.execute(SUBSCRIBED_USERS.format(user_filter='TRUE'))
+        columns = [c[0] for c in cursor.description]
+
+        sample()
+
+        for i, row in enumerate(cursor):
+            dict(zip(columns, row))
+
+            if i % 1000 == 0:
+                sample()
+
+        cursor.close()
+
+    def iterate_server_cursor(self, sample, fetch_size):
+        subscribed_users = SendNotificationsCommand().find_subscribed_users(fetch_size=fetch_size)
+
+        for i, user_subscriptions in enumerate(subscribed_users):
+            if i % 1000 == 0:
+                sample()
+
+    def measure_rss(self, iterate, *args):
+        # Peak resident memory above the baseline while iterating, sampled
+        # from /proc since ru_maxrss only ever grows within a process.
+
+        baseline = current_rss()
+        peak = [baseline]
+
+        sample = lambda: peak.append(current_rss())
+
+        iterate(sample, *args)
+        sample()
+
+        return max(peak) - baseline
+
+    def subscription_count(self, options):
+        count = int(self.random.paretovariate(options['skew'])) - 1
+        return min(count, options['max_subscriptions'])
+
+    def choose(self, ids, options):
+        # A user's share of ids, where the entity at rank r is followed in
+        # proportion to 1 / r ** zipf. Ranks are shuffled, so popularity
+        # has nothing to do with the order ids come in.
+
+        count = min(len(ids), self.subscription_count(options))
+
+        try:
+            ranked, cum_weights = self.cum_weights[id(ids)]
+        except KeyError:
+            ranked = list(ids)
+            self.random.shuffle(ranked)
+
+            cum_weights = []
+            total = 0
+
+            for rank in range(1, len(ranked) + 1):
+                total += 1.0 / rank ** options['zipf']
+                cum_weights.append(total)
+
+            self.cum_weights[id(ids)] = ranked, cum_weights
+
+        chosen = set()
+
+        while len(chosen) < count:
+            chosen.add(ranked[bisect.bisect(cum_weights, self.random.random() * cum_weights[-1])])
+
+        return sorted(chosen)
+
+    def seed_subscriptions(self, options, count, offset, bill_ids, person_ids, committee_ids):
+        last_user_id = User.objects.aggregate(Max('id'))['id__max'] or 0
+
+        users = [User(username='benchmark-{}'.format(i),
+                      email='benchmark-{}@example.com'.format(i))
+                 for i in range(offset, offset + count)]
+
+        User.objects.bulk_create(users, batch_size=5000)
+        users = User.objects.filter(id__gt=last_user_id, username__startswith='benchmark-')
+
+        subscriptions = {
+            BillActionSubscription: [],
+            BillSearchSubscription: [],
+            CommitteeActionSubscription: [],
+            CommitteeEventSubscription: [],
+            PersonSubscription: [],
+            EventsSubscription: [],
+        }
+
+        for user in users.iterator():
+
+            for bill_id in self.choose(bill_ids, options):
+                subscriptions[BillActionSubscription].append(
+                    BillActionSubscription(user=user, bill_id=bill_id))
+
+            for person_id in self.choose(person_ids, options):
+                subscriptions[PersonSubscription].append(
+                    PersonSubscription(user=user, person_id=person_id))
+
+            for committee_id in self.choose(committee_ids, options):
+                subscriptions[CommitteeActionSubscription].append(
+                    CommitteeActionSubscription(user=user, committee_id=committee_id))
+
+            for committee_id in self.choose(committee_ids, options):
+                subscriptions[CommitteeEventSubscription].append(
+                    CommitteeEventSubscription(user=user, committee_id=committee_id))
+
+            for term in self.choose(SEARCH_TERMS, options):
+                search_params = {'term': term, 'facets': {}}
+                subscriptions[BillSearchSubscription].append(
+                    BillSearchSubscription(user=user,
+                                           search_params=search_params,
+                                           search_key=search_hash(search_params)))
+
+            if self.random.random() < 0.1:
+                subscriptions[EventsSubscription].append(EventsSubscription(user=user))
+
+        for model, objects in subscriptions.items():
+            model.objects.bulk_create(objects, batch_size=5000)
+
+            if model in SUBSCRIBER_INDEX:
+                index_subscribers(model, objects)
+
+            self.stdout.write('Seeded {0} {1}'.format(len(objects), model.__name__))
+
+        cursor = connection.cursor()
+        cursor.execute('ANALYZE')
+
+    def time_query(self, query, repeat):
+        cursor = connection.cursor()
+
+        timings = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(query)
+            rows = len(cursor.fetchall())
+            timings.append(time.perf_counter() - start)
+
+        cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) {}'.format(query))
+        plan = cursor.fetchone()[0][0]
+
+        return {
+            'rows': rows,
+            'best_seconds': min(timings),
+            'mean_seconds': sum(timings) / len(timings),
+            'planning_ms': plan['Planning Time'],
+            'execution_ms': plan['Execution Time'],
+        }
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # No /proc outside Linux, so fall back to the peak.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
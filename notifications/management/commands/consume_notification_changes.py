@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+import select
+import uuid
+
+from django.db import transaction, connection
+
+from notifications.management.commands.send_notifications import \
+    Command as SendNotificationsCommand, add_queueing_arguments
+
+# Rows added to these tables are recorded as changes, under the name of the
+# staging table import_data would have put them in. Updated events are
+# recorded too, but only if something about them changed.
+CHANGE_TRIGGERS = (
+    ('councilmatic_core_action', 'INSERT', ''),
+    ('councilmatic_core_sponsorship', 'INSERT', ''),
+    ('councilmatic_core_bill', 'INSERT', ''),
+    ('councilmatic_core_event', 'INSERT', ''),
+    ('councilmatic_core_event', 'UPDATE', 'WHEN (OLD.* IS DISTINCT FROM NEW.*)'),
+)
+
+CLAIM_CHANGES = '''
+    UPDATE notifications_notificationchange
+    SET claim = %s
+    WHERE id IN (
+      SELECT id
+      FROM notifications_notificationchange
+      WHERE claim IS NULL
+      ORDER BY id
+      LIMIT %s
+      FOR UPDATE SKIP LOCKED
+    )
+'''
+
+# The users subscribed to anything the claimed changes touch, found from the
+# entity subscriber index rather than by visiting every subscriber.
+AFFECTED_USERS = '''
+    user_id IN (
+      SELECT user_id
+      FROM notifications_entitysubscriber
+      WHERE entity_type = 'bill_action'
+        AND entity_id IN (SELECT bill_id FROM {new_action} AS new)
+      UNION
+      SELECT user_id
+      FROM notifications_entitysubscriber
+      WHERE entity_type = 'committee_action'
+        AND entity_id IN (
+          SELECT action.organization_id
+          FROM councilmatic_core_action AS action
+          JOIN {new_action} AS new
+            ON action.bill_id = new.bill_id
+        )
+      UNION
+      SELECT user_id
+      FROM notifications_entitysubscriber
+      WHERE entity_type = 'committee_event'
+        AND entity_id IN (
+          SELECT committee.ocd_id
+          FROM councilmatic_core_organization AS committee
+          JOIN councilmatic_core_eventparticipant AS p
+            ON p.entity_name = committee.name
+          JOIN {new_event} AS new
+            ON p.event_id = new.ocd_id
+        )
+      UNION
+      SELECT user_id
+      FROM notifications_entitysubscriber
+      WHERE entity_type = 'person'
+        AND entity_id IN (SELECT person_id FROM {new_sponsorship} AS new)
+      UNION
+      SELECT user_id
+      FROM notifications_billsearchsubscription
+      WHERE EXISTS (SELECT 1 FROM {new_bill} AS new)
+      UNION
+      SELECT user_id
+      FROM notifications_eventssubscription
+      WHERE EXISTS (SELECT 1 FROM {new_event} AS new)
+         OR EXISTS (SELECT 1 FROM {change_event} AS change)
+    )
+'''
+
+
+def claim_lock_id(claim):
+    # The advisory lock a consumer holds on a claim while sending it. Claims
+    # are hex UUIDs, the first 60 bits of which fit in a bigint.
+    return int(claim[:15], 16)
+
+
+def outbox_sources(claim):
+    # Stand-ins for the staging tables covering the changes in one claim.
+    # Claims are generated here, so they are safe to inline.
+
+    changes = "FROM notifications_notificationchange WHERE claim = '{0}' AND source = '{1}'"
+
+    return {
+        'new_action': '(SELECT DISTINCT object_id AS bill_id {})'.format(changes.format(claim, 'new_action')),
+        'new_bill': '(SELECT DISTINCT object_id AS ocd_id {})'.format(changes.format(claim, 'new_bill')),
+        'new_sponsorship': '(SELECT DISTINCT object_id AS bill_id, person_id {})'.format(changes.format(claim, 'new_sponsorship')),
+        'new_event': '(SELECT DISTINCT object_id AS ocd_id {})'.format(changes.format(claim, 'new_event')),
+        'change_event': '(SELECT DISTINCT object_id AS ocd_id {})'.format(changes.format(claim, 'change_event')),
+    }
+
+
+class Command(SendNotificationsCommand):
+
+    help = 'Send notifications as the import records changes, rather than for everything at once. Use this instead of a scheduled send_notifications, not alongside it.'
+
+    def add_arguments(self, parser):
+        add_queueing_arguments(parser)
+        parser.add_argument(
+            '--changes-per-run',
+            type=int,
+            default=50000,
+            help='Most changes to send notifications for at once.'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=int,
+            default=60,
+            help='Seconds to wait for a notification of new changes before checking anyway.'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Send notifications for the changes recorded so far, then exit.'
+        )
+        parser.add_argument(
+            '--uninstall',
+            action='store_true',
+            default=False,
+            help='Stop recording changes, and exit.'
+        )
+
+    def handle(self, *args, **options):
+
+        if options['uninstall']:
+            self.uninstall_triggers()
+            return
+
+        self.install_triggers()
+
+        options = dict(options,
+                       users='all',
+                       workers=1,
+                       incremental=False,
+                       run_id=None)
+
+        cursor = connection.cursor()
+        cursor.execute('LISTEN notifications_changes')
+
+        while True:
+            self.resume_stale_claims(options)
+
+            while self.consume_changes(options):
+                pass
+
+            if options['once']:
+                break
+
+            self.wait_for_changes(options['poll_interval'])
+
+    def install_triggers(self):
+        cursor = connection.cursor()
+
+        with transaction.atomic():
+            for table, event, condition in CHANGE_TRIGGERS:
+                trigger = 'notifications_{0}_{1}'.format(table, event.lower())
+
+                cursor.execute('DROP TRIGGER IF EXISTS {0} ON {1}'.format(trigger, table))
+                cursor.execute('''
+                    CREATE TRIGGER {0}
+                    AFTER {1} ON {2}
+                    FOR EACH ROW {3}
+                    EXECUTE PROCEDURE notifications_record_change()
+                '''.format(trigger, event, table, condition))
+
+    def uninstall_triggers(self):
+        cursor = connection.cursor()
+
+        with transaction.atomic():
+            for table, event, condition in CHANGE_TRIGGERS:
+                trigger = 'notifications_{0}_{1}'.format(table, event.lower())
+                cursor.execute('DROP TRIGGER IF EXISTS {0} ON {1}'.format(trigger, table))
+
+    def resume_stale_claims(self, options):
+        # Changes claimed by a consumer that stopped before it was done with
+        # them, or left because saved searches failed, are sent again under
+        # the same claim. The claim is the run ID, so the delivery ledger
+        # skips the digests that already went out.
+
+        for claim in self.stale_claims():
+            try:
+                self.consume_claim(claim, options)
+            finally:
+                self.unlock_claim(claim)
+
+    def stale_claims(self):
+        # Claims still holding changes that no running consumer has locked,
+        # locked for this one.
+
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT DISTINCT claim
+            FROM notifications_notificationchange
+            WHERE claim IS NOT NULL
+        ''')
+
+        return [claim for claim, in cursor.fetchall() if self.lock_claim(claim)]
+
+    def lock_claim(self, claim):
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [claim_lock_id(claim)])
+
+        return cursor.fetchone()[0]
+
+    def unlock_claim(self, claim):
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_advisory_unlock(%s)', [claim_lock_id(claim)])
+
+    def consume_changes(self, options):
+        # Claims a share of the recorded changes and sends digests for the
+        # users they affect. The claim is committed on its own, so no rows
+        # stay locked while Solr is searched and digests are queued. Returns
+        # whether there were any changes.
+
+        claim = uuid.uuid4().hex
+
+        # Locked before the changes are claimed, so that no other consumer
+        # can take them for stale in between.
+        self.lock_claim(claim)
+
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute(CLAIM_CHANGES, [claim, options['changes_per_run']])
+
+                if not cursor.rowcount:
+                    return False
+
+            self.consume_claim(claim, options)
+
+        finally:
+            self.unlock_claim(claim)
+
+        return True
+
+    def consume_claim(self, claim, options):
+        # Queues digests for the users affected by the changes in a claim,
+        # then deletes the changes. If anything fails before that, or any
+        # saved search fails, they stay claimed, and are sent again under the
+        # same claim.
+
+        sources = outbox_sources(claim)
+
+        self.start_run(options, run_id=claim)
+        self.start_cohort((0, sources, (AFFECTED_USERS.format(**sources), {})))
+
+        stats, last_user_id, output, results = self.send_shard()
+
+        self.instrumentation.close()
+
+        if self.searches_failed:
+            self.stderr.write('Saved searches failed, so changes claimed as {} are kept to retry'.format(claim))
+            return
+
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM notifications_notificationchange WHERE claim = %s', [claim])
+
+        if options['verbosity'] > 1:
+            self.stdout.write('Changes: {0}, users: {1}, digests queued: {2}'.format(cursor.rowcount,
+                                                                                 stats['users'],
+                                                                                 stats['digests'] - stats['delivered']))
+
+    def wait_for_changes(self, timeout):
+        pg_connection = connection.connection
+
+        if select.select([pg_connection], [], [], timeout) == ([], [], []):
+            return
+
+        pg_connection.poll()
+        del pg_connection.notifies[:]
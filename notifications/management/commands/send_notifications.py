@@ -2,175 +2,815 @@
 
 import os
 import json
-from collections import OrderedDict
+import hashlib
+import logging
+import pickle
+import smtplib
+import time
+import uuid
+from collections import OrderedDict, Counter, namedtuple
 import itertools
+import multiprocessing
 import requests
-from datetime import date
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from io import StringIO
 
 import django_rq
 import pysolr
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 
 from django.db import transaction, connection
 from django.db.utils import ProgrammingError
 
-from django.template.loader import get_template
 from django.conf import settings
+from django.utils import timezone
 
 from django.contrib.auth.models import User
 
+from notifications.models import NotificationDelivery
+from notifications.utils import canonical_search
+from notifications.digests import Digest, DIGEST_SECTIONS
+from notifications.fragments import render_notification
+from notifications.results import RunResults, json_default
+from notifications.instrumentation import RecordingInstrumentation, get_instrumentation
+
+logger = logging.getLogger(__name__)
+
 try:
     haystack_url = settings.HAYSTACK_CONNECTIONS['default']['URL']
 except KeyError:
     haystack_url = None
 
+solr_timeout = getattr(settings, 'NOTIFICATIONS_SOLR_TIMEOUT', 10)
+solr_concurrency = getattr(settings, 'NOTIFICATIONS_SOLR_CONCURRENCY', 4)
+
+email_batch_size = getattr(settings, 'NOTIFICATIONS_EMAIL_BATCH_SIZE', 100)
+messages_per_connection = getattr(settings, 'NOTIFICATIONS_MESSAGES_PER_CONNECTION', 100)
+
+subscribed_users_fetch_size = getattr(settings, 'NOTIFICATIONS_FETCH_SIZE', 2000)
+
+incremental_lookback = timedelta(hours=getattr(settings, 'NOTIFICATIONS_INCREMENTAL_LOOKBACK', 24))
+
+shared_payload_ttl = getattr(settings, 'NOTIFICATIONS_SHARED_PAYLOAD_TTL', 60 * 60 * 24 * 7)
+
+SUBSCRIBED_USERS = '''
+    SELECT
+      u.id AS user_id,
+      u.email AS user_email,
+      bas.bill_ids AS bill_action_ids,
+      bss.search_params AS bill_search_params,
+      cas.committee_ids AS committee_action_ids,
+      ces.committee_ids AS committee_event_ids,
+      ps.person_ids AS person_ids,
+      es.user_id IS NOT NULL AS event_subscription
+    FROM auth_user AS u
+    LEFT JOIN (
+      SELECT user_id, array_agg(DISTINCT bill_id) AS bill_ids
+      FROM notifications_billactionsubscription
+      WHERE {user_filter}
+      GROUP BY user_id
+    ) AS bas
+      ON u.id = bas.user_id
+    LEFT JOIN (
+      SELECT user_id, array_agg(DISTINCT search_params) AS search_params
+      FROM notifications_billsearchsubscription
+      WHERE {user_filter}
+        AND search_params IS NOT NULL
+      GROUP BY user_id
+    ) AS bss
+      ON u.id = bss.user_id
+    LEFT JOIN (
+      SELECT user_id, array_agg(DISTINCT committee_id) AS committee_ids
+      FROM notifications_committeeactionsubscription
+      WHERE {user_filter}
+      GROUP BY user_id
+    ) AS cas
+      ON u.id = cas.user_id
+    LEFT JOIN (
+      SELECT user_id, array_agg(DISTINCT committee_id) AS committee_ids
+      FROM notifications_committeeeventsubscription
+      WHERE {user_filter}
+      GROUP BY user_id
+    ) AS ces
+      ON u.id = ces.user_id
+    LEFT JOIN (
+      SELECT user_id, array_agg(DISTINCT person_id) AS person_ids
+      FROM notifications_personsubscription
+      WHERE {user_filter}
+      GROUP BY user_id
+    ) AS ps
+      ON u.id = ps.user_id
+    LEFT JOIN (
+      SELECT DISTINCT user_id
+      FROM notifications_eventssubscription
+      WHERE {user_filter}
+    ) AS es
+      ON u.id = es.user_id
+    WHERE (bas.user_id IS NOT NULL
+           OR bss.user_id IS NOT NULL
+           OR cas.user_id IS NOT NULL
+           OR ces.user_id IS NOT NULL
+           OR ps.user_id IS NOT NULL
+           OR es.user_id IS NOT NULL)
+    ORDER BY u.id
+'''
+
+SUBSCRIBED_ENTITIES = '''
+    SELECT 'bill_search', search_params::text
+    FROM (
+      SELECT DISTINCT ON (search_key) search_params
+      FROM notifications_billsearchsubscription
+      WHERE {user_filter}
+        AND search_key IS NOT NULL
+    ) AS bss
+    UNION
+    SELECT 'bill_action', bill_id
+    FROM notifications_billactionsubscription
+    WHERE {user_filter}
+    UNION
+    SELECT 'committee_action', committee_id
+    FROM notifications_committeeactionsubscription
+    WHERE {user_filter}
+    UNION
+    SELECT 'committee_event', committee_id
+    FROM notifications_committeeeventsubscription
+    WHERE {user_filter}
+    UNION
+    SELECT 'person', person_id
+    FROM notifications_personsubscription
+    WHERE {user_filter}
+'''
+
+# Where each kind of update comes from. By default these are the staging
+# tables import_data fills with what changed in the last import.
+STAGING_SOURCES = {
+    'new_action': 'new_action',
+    'new_bill': 'new_bill',
+    'new_sponsorship': 'new_sponsorship',
+    'new_event': 'new_event',
+    'change_event': 'change_event',
+}
+
+def incremental_sources(since, until):
+    # Stand-ins for the staging tables covering the rows updated between two
+    # points in time. The bounds are datetimes generated by the command, so
+    # they are safe to inline.
+
+    window = "updated_at > '{0}'::timestamptz AND updated_at <= '{1}'::timestamptz"\
+        .format(since.isoformat(), until.isoformat())
+    created = "ocd_created_at > '{}'::timestamptz".format(since.isoformat())
+
+    return {
+        'new_action': '''(
+            SELECT DISTINCT bill_id FROM councilmatic_core_action WHERE {0}
+        )'''.format(window),
+        'new_bill': '''(
+            SELECT ocd_id FROM councilmatic_core_bill WHERE {0} AND {1}
+        )'''.format(window, created),
+        'new_sponsorship': '''(
+            SELECT bill_id, person_id FROM councilmatic_core_sponsorship WHERE {0}
+        )'''.format(window),
+        'new_event': '''(
+            SELECT ocd_id FROM councilmatic_core_event WHERE {0} AND {1}
+        )'''.format(window, created),
+        'change_event': '''(
+            SELECT ocd_id FROM councilmatic_core_event WHERE {0} AND NOT {1}
+        )'''.format(window, created),
+    }
+
+# An event in a committee's event updates. Digests are pickled into RQ for
+# every subscriber, so these carry only what the templates show.
+CommitteeEvent = namedtuple('CommitteeEvent', ['name', 'slug', 'start_time', 'description'])
+
+def add_queueing_arguments(parser):
+    # Options for how digests are queued, shared with
+    # consume_notification_changes.
+
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        default=False,
+        help='Queue digests in batches that are each sent over one mail connection.'
+    )
+    parser.add_argument(
+        '--shared-payload',
+        action='store_true',
+        default=False,
+        help='Store each update once per run in Redis and queue only its key with each digest.'
+    )
+    parser.add_argument(
+        '--fetch-size',
+        type=int,
+        default=subscribed_users_fetch_size,
+        help='Number of subscribed users to fetch from the database at a time.'
+    )
+
+_shard_command = None
+
+def _send_shard(shard_args):
+    return _shard_command.send_shard(*shard_args)
+
 class Command(BaseCommand):
 
     help = 'Send email notifications to subscribed users'
 
+    sources = STAGING_SOURCES
+    cohort_filter = None
+    payload_prefix = ''
+    # Whether to keep what each user was sent in RunResults.users, when not
+    # writing it to --results-jsonl.
+    keep_user_results = False
+    # Whether any saved search failed for the current cohort.
+    searches_failed = False
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--users',
             default='all',
             help='Comma separated list of usernames to send notifications to.'
         )
+        add_queueing_arguments(parser)
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes to build digests in, each taking a share of the subscribed users.'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Send each user the updates since their last incremental run, instead of those in the staging tables.'
+        )
+        parser.add_argument(
+            '--run-id',
+            default=None,
+            help='ID of a run to retry. Digests the delivery ledger records as sent in that run are not sent again.'
+        )
+        parser.add_argument(
+            '--results-jsonl',
+            default=None,
+            help='File to write what each user was sent to as JSON Lines, followed by a summary of the run.'
+        )
+        parser.add_argument(
+            '--instrument',
+            action='store_true',
+            default=False,
+            help='Time each stage of the run and count its queries, and print a summary at the end.'
+        )
 
     def handle(self, *args, **options):
 
-        subscribed_users = '''
-            SELECT
-              u.id AS user_id,
-              MAX(u.email) as user_email,
-              array_agg(DISTINCT bas.bill_id) AS bill_action_ids,
-              array_agg(DISTINCT bss.search_params) AS bill_search_params,
-              array_agg(DISTINCT cas.committee_id) AS committee_action_ids,
-              array_agg(DISTINCT ces.committee_id) AS committee_event_ids,
-              array_agg(DISTINCT ps.person_id) as person_ids,
-              bool_and(es.id::bool) AS event_subscription
-            FROM auth_user AS u
-            LEFT JOIN notifications_billactionsubscription AS bas
-              ON u.id = bas.user_id
-            LEFT JOIN notifications_billsearchsubscription AS bss
-              ON u.id = bss.user_id
-            LEFT JOIN notifications_committeeactionsubscription AS cas
-              ON u.id = cas.user_id
-            LEFT JOIN notifications_committeeeventsubscription AS ces
-              ON u.id = ces.user_id
-            LEFT JOIN notifications_personsubscription AS ps
-              ON u.id = ps.user_id
-            LEFT JOIN notifications_eventssubscription AS es
-              ON u.id = es.user_id
-            WHERE (bas.bill_id IS NOT NULL
-                   OR bss.search_params IS NOT NULL
-                   OR cas.committee_id IS NOT NULL
-                   OR ces.committee_id IS NOT NULL
-                   OR ps.person_id IS NOT NULL
-                   OR es.id IS NOT NULL)
-        '''
+        self.start_run(options)
+
+        if options['incremental']:
+            # Users are grouped by how far they have already been sent
+            # updates, and each group gets the updates between there and the
+            # start of this run.
+            self.until = timezone.now()
+            cohorts = self.find_watermark_cohorts()
+        else:
+            cohorts = [None]
+
+        results = []
+
+        for cohort in cohorts:
+            self.start_cohort(cohort)
+            results.extend(self.send_shards())
+
+        stats = Counter()
+        output = None
+        last_user_id = None
+
+        for shard_stats, shard_user_id, shard_output, shard_results in results:
+            stats.update(shard_stats)
+            self.results.merge(shard_results)
+
+            if shard_user_id is not None and (last_user_id is None or shard_user_id > last_user_id):
+                last_user_id = shard_user_id
+                output = shard_output
+
+        stats['cache_hits'] += self.run_cache_stats['hits']
+        stats['cache_misses'] += self.run_cache_stats['misses']
+
+        self.results.stats = stats
+        self.results.output = output
+        self.results.finish()
+
+        if output is None:
+            self.stdout.write('no email')
+
+        else:
+            self.stdout.write(json.dumps(output, default=json_default))
+
+        if options['verbosity'] > 1:
+            self.stdout.write('Run: {}'.format(self.run_id))
+            self.stdout.write('Users: {0}, digests queued: {1}, already delivered: {2}'.format(stats['users'],
+                                                                                          stats['digests'] - stats['delivered'],
+                                                                                          stats['delivered']))
+            self.stdout.write('Run cache: {0} hits, {1} misses'.format(stats['cache_hits'],
+                                                                     stats['cache_misses']))
+
+        if self.results.solr_errors:
+            self.stderr.write('{} saved searches failed, so their updates were not sent'.format(len(self.results.solr_errors)))
+
+        if self.instrumentation.recording:
+            self.write_stage_summary(self.instrumentation.summary())
+
+        self.instrumentation.close()
+
+    def write_stage_summary(self, summary):
+        self.stdout.write('{0:<45} {1:>7} {2:>9} {3:>8} {4:>8} {5:>8} {6:>8}'.format(
+            'Stage', 'Count', 'Total s', 'p50 ms', 'p95 ms', 'p99 ms', 'Queries'))
+
+        for stage, timing in sorted(summary.items()):
+            self.stdout.write('{0:<45} {1:>7} {2:>9.3f} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8}'.format(
+                stage,
+                timing['count'],
+                timing['total_seconds'],
+                timing['p50'] * 1000,
+                timing['p95'] * 1000,
+                timing['p99'] * 1000,
+                timing['queries']))
+
+    def start_run(self, options, run_id=None):
+        self.options = options
+
+        self.run_id = run_id or options.get('run_id') or uuid.uuid4().hex
+        self.run_cache = {}
+        self.run_cache_stats = Counter()
+
+        self.shared_fields = {}
+        self.shared_updates = {}
+        self.stored_fields = set()
+
+        instrumentation = get_instrumentation()
+
+        if instrumentation.recording:
+            # A fresh one, so the summary covers just this run.
+            self.instrumentation = instrumentation.__class__()
+        elif options.get('instrument'):
+            self.instrumentation = RecordingInstrumentation()
+        else:
+            self.instrumentation = instrumentation
 
-        q_args = []
+        self.instrumentation.start()
 
-        if options['users'] != 'all':
-            users = tuple(options['users'].split(','))
-            subscribed_users = '{} AND u.username IN %s'.format(subscribed_users)
-            q_args.append(users)
+        results_jsonl = options.get('results_jsonl')
 
+        self.results = RunResults(self.run_id,
+                                  results_jsonl,
+                                  self.instrumentation,
+                                  keep_users=self.keep_user_results and not results_jsonl)
+        self.results.start()
+
+    def start_cohort(self, cohort):
+        # Finds and indexes the updates for the users in a cohort, or for
+        # everyone in the staging tables if cohort is None. A cohort is a
+        # number identifying it within the run, the sources its updates come
+        # from, and a filter selecting its users.
+
+        options = self.options
+
+        if cohort is None:
+            self.sources = STAGING_SOURCES
+            self.cohort_filter = None
+            self.payload_prefix = ''
+
+        else:
+            cohort_number, self.sources, self.cohort_filter = cohort
+            self.payload_prefix = 'cohort-{}:'.format(cohort_number)
+
+        solr_errors = len(self.results.solr_errors)
+
+        # Cached results and shared fields belong to one set of sources.
+        self.run_cache = {}
+        self.shared_fields = {}
+        self.shared_updates = {}
+
+        # Each kind of update is found once for everything anyone follows and
+        # indexed by the ID of the followed entity. Digests are then assembled
+        # per user from the indexes without going back to the database.
+        entity_ids = self.find_subscribed_entities(options['users'])
+
+        self.bill_action_index = {}
+        self.bill_search_index = {}
+        self.committee_action_index = {}
+        self.committee_event_index = {}
+        self.person_index = {}
+
+        if entity_ids['bill_action']:
+            with self.results.time_finder('find_bill_action_updates'):
+                self.bill_action_index = self.find_bill_action_updates(entity_ids['bill_action'])
+
+        if entity_ids['bill_search']:
+            search_params = [json.loads(key) for key in entity_ids['bill_search']]
+
+            with self.results.time_finder('find_bill_search_updates'):
+                self.bill_search_index = self.find_bill_search_updates(search_params)
+
+        # If any saved search failed, this cohort's search updates are
+        # incomplete, so the window they cover must not count as sent.
+        self.searches_failed = len(self.results.solr_errors) > solr_errors
+
+        if entity_ids['committee_action']:
+            with self.results.time_finder('find_committee_action_updates'):
+                self.committee_action_index = self.find_committee_action_updates(entity_ids['committee_action'])
+
+        if entity_ids['committee_event']:
+            with self.results.time_finder('find_committee_event_updates'):
+                self.committee_event_index = self.find_committee_event_updates(entity_ids['committee_event'])
+
+        if entity_ids['person']:
+            with self.results.time_finder('find_person_updates'):
+                self.person_index = self.find_person_updates(entity_ids['person'])
+
+        if options['shared_payload']:
+            indexes = (
+                ('bill_action', self.bill_action_index),
+                ('bill_search', self.bill_search_index),
+                ('committee_action', self.committee_action_index),
+                ('committee_event', self.committee_event_index),
+                ('person', self.person_index),
+            )
+
+            for prefix, index in indexes:
+                for entity_id, update in index.items():
+                    self.share_update('{0}:{1}'.format(prefix, entity_id), update)
+
+    def send_shards(self):
+        workers = self.options['workers']
+
+        if workers > 1:
+            # The connection is closed before forking, which cannot be done
+            # in the middle of a transaction.
+            if connection.in_atomic_block:
+                raise CommandError('--workers cannot be more than 1 inside a transaction')
+
+            # Shards are forked from this process, so they share the indexes
+            # built above. Each opens its own database connection.
+            global _shard_command
+            _shard_command = self
+
+            connection.close()
+
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                return pool.map(_send_shard, [(shard, workers) for shard in range(workers)])
+
+        else:
+            return [self.send_shard()]
+
+    def find_watermark_cohorts(self):
+        # One cohort for each point users have been sent updates up to, and
+        # one for users who have never had an incremental run, who get
+        # NOTIFICATIONS_INCREMENTAL_LOOKBACK worth of updates.
 
-        subscribed_users = '{} GROUP BY u.id'.format(subscribed_users)
         cursor = connection.cursor()
-        cursor.execute(subscribed_users, q_args)
-        columns = [c[0] for c in cursor.description]
+        cursor.execute('''
+            SELECT DISTINCT sent_until
+            FROM notifications_subscriptionwatermark
+            WHERE sent_until < %s
+            ORDER BY sent_until
+        ''', [self.until])
 
-        bill_action_updates = []
-        bill_search_updates = []
-        committee_action_updates = []
-        committee_event_updates = []
-        person_updates = []
+        cohorts = [(0,
+                    incremental_sources(self.until - incremental_lookback, self.until),
+                    ('user_id NOT IN (SELECT user_id FROM notifications_subscriptionwatermark)', {}))]
+
+        for cohort_number, (since,) in enumerate(cursor, start=1):
+            cohort_filter = ('''user_id IN (SELECT user_id
+                                         FROM notifications_subscriptionwatermark
+                                         WHERE sent_until = %(since)s)''',
+                             {'since': since})
+
+            cohorts.append((cohort_number, incremental_sources(since, self.until), cohort_filter))
 
-        send_notification = False
+        return cohorts
+
+    def advance_watermarks(self, user_ids):
+        if not user_ids:
+            return
+
+        cursor = connection.cursor()
+        cursor.executemany('''
+            INSERT INTO notifications_subscriptionwatermark (user_id, sent_until)
+            VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET sent_until = EXCLUDED.sent_until
+        ''', [(user_id, self.until) for user_id in user_ids])
+
+    def send_shard(self, shard=None, shards=1):
+        # Builds and queues digests for the subscribed users in one shard, or
+        # all of them if no shard is given. Returns the shard's stats, along
+        # with the last user to get a digest, what that digest contained, and
+        # the shard's results.
+
+        options = self.options
+        results = self.results.for_shard()
+
+        stats = Counter()
         output = None
+        last_user_id = None
+        pending_digests = []
+        pending_user_ids = []
+        pending_sections = []
 
-        for row in cursor:
-            user_subscriptions = dict(zip(columns, row))
+        cache_hits = self.run_cache_stats['hits']
+        cache_misses = self.run_cache_stats['misses']
 
-            bill_action_ids = [i for i in user_subscriptions['bill_action_ids'] if i]
-            bill_search_params = [i for i in user_subscriptions['bill_search_params'] if i]
-            committee_action_ids = [i for i in user_subscriptions['committee_action_ids'] if i]
-            committee_event_ids = [i for i in user_subscriptions['committee_event_ids'] if i]
-            person_ids = [i for i in user_subscriptions['person_ids'] if i]
-            event_subscription = user_subscriptions['event_subscription']
+        subscribed_users = self.find_subscribed_users(options['users'],
+                                                      shard,
+                                                      shards,
+                                                      fetch_size=options['fetch_size'])
 
-            send_notification = False
+        for user_subscriptions in subscribed_users:
 
-            if bill_action_ids:
-                bill_action_updates = self.find_bill_action_updates(bill_action_ids)
+            stats['users'] += 1
 
-                if bill_action_updates:
-                    send_notification = True
+            # Users whose saved searches could not be run keep their
+            # watermark, so they get this window's search updates next time.
+            if not (self.searches_failed and user_subscriptions['bill_search_params']):
+                pending_user_ids.append(user_subscriptions['user_id'])
 
-            if bill_search_params:
-                bill_search_updates = self.find_bill_search_updates(bill_search_params)
+            bill_action_ids = user_subscriptions['bill_action_ids']
+            bill_search_params = user_subscriptions['bill_search_params']
+            committee_action_ids = user_subscriptions['committee_action_ids']
+            committee_event_ids = user_subscriptions['committee_event_ids']
+            person_ids = user_subscriptions['person_ids']
 
-                if bill_search_updates:
-                    send_notification = True
+            # Every user starts from an empty digest, so that it depends only
+            # on their subscriptions and not on who came before them.
+            digest = Digest(user_subscriptions['user_id'], user_subscriptions['user_email'])
 
-            if committee_action_ids:
-                committee_action_updates = self.find_committee_action_updates(committee_action_ids)
+            if bill_action_ids:
+                digest.bill_action_updates = self.lookup_updates(self.bill_action_index,
+                                                                 bill_action_ids)
 
-                if committee_action_updates:
-                    send_notification = True
+            if bill_search_params:
+                digest.bill_search_updates = self.lookup_search_updates(self.bill_search_index,
+                                                                        bill_search_params)
 
-            if committee_event_ids:
-                committee_event_updates = self.find_committee_event_updates(committee_event_ids)
+            if committee_action_ids:
+                digest.committee_action_updates = self.lookup_updates(self.committee_action_index,
+                                                                      committee_action_ids,
+                                                                      key=lambda x: x['slug'])
 
-                if committee_event_updates:
-                    send_notification = True
+            if committee_event_ids:
+                digest.committee_event_updates = self.lookup_updates(self.committee_event_index,
+                                                                     committee_event_ids,
+                                                                     key=lambda x: x['slug'])
 
             if person_ids:
-                person_updates = self.find_person_updates(person_ids)
-
-                if person_updates:
-                    send_notification = True
-
-            new_events = []
-            updated_events = []
-
-            if event_subscription:
-                new_events = self.find_new_events()
-                updated_events = self.find_updated_events()
-
-                if new_events or updated_events:
-                    send_notification = True
-
-            if send_notification:
-                send_notification_email.delay(user_id=user_subscriptions['user_id'],
-                                              user_email=user_subscriptions['user_email'],
-                                              bill_action_updates=bill_action_updates,
-                                              bill_search_updates=bill_search_updates,
-                                              person_updates=person_updates,
-                                              committee_action_updates=committee_action_updates,
-                                              committee_event_updates=committee_event_updates,
-                                              updated_events=updated_events,
-                                              new_events=new_events)
-
-                output = dict(bill_action_updates=bill_action_updates,
-                              bill_search_updates=bill_search_updates,
-                              person_updates=person_updates,
-                              committee_action_updates=committee_action_updates,
-                              committee_event_updates=committee_event_updates,
-                              updated_events=updated_events,
-                              new_events=new_events)
+                digest.person_updates = self.lookup_updates(self.person_index,
+                                                            person_ids,
+                                                            key=lambda x: list(x.values())[0]['slug'])
 
-        if output is None:
-            self.stdout.write('no email')
+            if user_subscriptions['event_subscription']:
+                digest.new_events = self.cached(self.find_new_events, results=results)
+                digest.updated_events = self.cached(self.find_updated_events, results=results)
+
+                if options['shared_payload']:
+                    self.share_update('events:new', digest.new_events)
+                    self.share_update('events:updated', digest.updated_events)
+
+            if digest:
+                last_user_id = digest.user_id
+                output = digest.sections()
+
+                pending_sections.append((digest.user_id, digest.section_counts()))
+
+                delivery = (self.run_id, digest_hash(digest))
+
+                if options['shared_payload']:
+                    digest = self.shared_digest(digest)
+
+                digest.delivery = delivery
+
+                pending_digests.append(digest)
+
+                stats['digests'] += 1
+
+            if len(pending_user_ids) >= options['fetch_size'] or \
+                    (options['batch'] and len(pending_digests) >= email_batch_size):
+                stats['delivered'] += self.queue_digests(results, pending_digests, pending_sections, pending_user_ids)
+                pending_digests = []
+                pending_sections = []
+                pending_user_ids = []
+
+        stats['delivered'] += self.queue_digests(results, pending_digests, pending_sections, pending_user_ids)
+
+        if shard is not None:
+            # Counts from a forked shard are lost with it unless returned.
+            stats['cache_hits'] = self.run_cache_stats['hits'] - cache_hits
+            stats['cache_misses'] = self.run_cache_stats['misses'] - cache_misses
+
+        return stats, last_user_id, output, results
+
+    def queue_digests(self, results, digests, sections, user_ids):
+        # Queues the digests the delivery ledger does not already record as
+        # sent, recording each user's digest and job in results, and returns
+        # how many it skipped. With --incremental, the
+        # watermarks of every user considered since the last call advance in
+        # the same transaction their digests are queued in. If queueing
+        # fails, they are picked up again next run.
+
+        delivered = delivered_digests(digests)
+
+        if delivered:
+            digests = [d for d in digests if delivery_key(d) not in delivered]
+
+        job_ids = {}
+
+        with transaction.atomic():
+            if self.options['incremental']:
+                self.advance_watermarks(user_ids)
+
+            if self.options['batch']:
+                if digests:
+                    job = send_notification_emails.delay(digests)
+                    job_ids = {digest.user_id: job.id for digest in digests}
+
+            else:
+                for digest in digests:
+                    job_ids[digest.user_id] = send_notification_email.delay(digest).id
+
+        results.record_users(sections, job_ids)
+
+        return len(delivered)
+
+    def share_update(self, field, update):
+        # Updates are identified by the objects themselves, which the indexes
+        # keep alive for the whole run, so a digest's sections can be mapped
+        # back to the fields they are stored under.
+        field = '{0}{1}'.format(self.payload_prefix, field)
+
+        self.shared_fields[id(update)] = field
+        self.shared_updates[field] = update
+
+    def shared_digest(self, digest):
+        # Replaces each update in the digest with the key it is stored under
+        # in this run's Redis hash, storing any updates not stored yet.
 
+        fields = lambda updates: [self.shared_fields[id(u)] for u in updates]
+        event_fields = lambda events: [self.shared_fields[id(events)]] if events else []
+
+        update_keys = {
+            'bill_action_updates': fields(digest.bill_action_updates),
+            'bill_search_updates': [(u['params'], self.shared_fields[id(u['bills'])])
+                                    for u in digest.bill_search_updates],
+            'person_updates': fields(digest.person_updates),
+            'committee_action_updates': fields(digest.committee_action_updates),
+            'committee_event_updates': fields(digest.committee_event_updates),
+            'updated_events': event_fields(digest.updated_events),
+            'new_events': event_fields(digest.new_events),
+        }
+
+        unstored = set(digest_fields(update_keys)) - self.stored_fields
+
+        if unstored:
+            redis = django_rq.get_connection()
+            redis.hmset(shared_payload_key(self.run_id),
+                        {f: pickle.dumps(self.shared_updates[f]) for f in unstored})
+            redis.expire(shared_payload_key(self.run_id), shared_payload_ttl)
+
+            self.stored_fields.update(unstored)
+
+        return Digest(digest.user_id,
+                      digest.user_email,
+                      run_id=self.run_id,
+                      update_keys=update_keys)
+
+    def cached(self, finder, *args, results=None):
+        # Memoizes finders whose results do not depend on the user for the
+        # rest of the run. Arguments must be hashable. Calls from a shard
+        # are timed in the shard's results, which are handed back to be
+        # merged, unlike the copy of the run's results a forked shard has.
+
+        key = (finder.__name__,) + args
+
+        try:
+            result = self.run_cache[key]
+        except KeyError:
+            self.run_cache_stats['misses'] += 1
+
+            with (results or self.results).time_finder(finder.__name__):
+                result = self.run_cache[key] = finder(*args)
         else:
-            dthandler = lambda x: x.isoformat() if isinstance(x, date) else None
-            self.stdout.write(json.dumps(output, default=dthandler))
+            self.run_cache_stats['hits'] += 1
+
+        return result
+
+    def user_filter(self, users='all'):
+        # Returns a WHERE clause restricting subscription tables to the given
+        # usernames, along with its query arguments, or None if none of the
+        # usernames exist.
+
+        if users == 'all':
+            user_filter, q_args = 'TRUE', {}
+
+        else:
+            usernames = users.split(',')
+            user_ids = tuple(User.objects.filter(username__in=usernames)\
+                                         .values_list('id', flat=True))
+
+            if not user_ids:
+                return None
+
+            user_filter, q_args = 'user_id IN %(user_ids)s', {'user_ids': user_ids}
+
+        if self.cohort_filter:
+            cohort_filter, cohort_args = self.cohort_filter
+
+            user_filter = '{0} AND {1}'.format(user_filter, cohort_filter)
+            q_args = dict(q_args, **cohort_args)
+
+        return user_filter, q_args
+
+    def find_subscribed_users(self, users='all', shard=None, shards=1, fetch_size=None):
+        # Each subscription type is aggregated on its own before being joined
+        # to auth_user, so a user with many subscriptions of several types
+        # costs the sum of their subscriptions rather than the product.
+        #
+        # Rows are streamed from a server-side cursor fetch_size at a time,
+        # so memory use does not grow with the number of subscribers.
+
+        user_filter = self.user_filter(users)
+
+        if user_filter is None:
+            return
+
+        user_filter, q_args = user_filter
+
+        if shard is not None:
+            user_filter = '{} AND mod(user_id, %(shards)s) = %(shard)s'.format(user_filter)
+            q_args = dict(q_args, shard=shard, shards=shards)
+
+        fetch_size = fetch_size or subscribed_users_fetch_size
+
+        # Django's cursors are client-side, so this uses psycopg2 directly.
+        # WITH HOLD lets the cursor live outside a transaction.
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name='subscribed_users_{}'.format(uuid.uuid4().hex),
+                                              withhold=True)
+
+        try:
+            cursor.execute(SUBSCRIBED_USERS.format(user_filter=user_filter), q_args)
+
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+
+                if not rows:
+                    break
+
+                columns = [c[0] for c in cursor.description]
+
+                for row in rows:
+                    yield dict(zip(columns, row))
+
+        finally:
+            cursor.close()
+
+    def find_subscribed_entities(self, users='all'):
+        # The union of everything the given users follow, by subscription
+        # type, so that each kind of update can be found once for all of them.
 
+        entity_ids = {
+            'bill_action': set(),
+            'bill_search': set(),
+            'committee_action': set(),
+            'committee_event': set(),
+            'person': set(),
+        }
+
+        user_filter = self.user_filter(users)
+
+        if user_filter is None:
+            return entity_ids
+
+        user_filter, q_args = user_filter
+
+        cursor = connection.cursor()
+        cursor.execute(SUBSCRIBED_ENTITIES.format(user_filter=user_filter), q_args)
+
+        for subscription_type, entity_id in cursor:
+            if subscription_type == 'bill_search':
+                entity_id = canonical_search(json.loads(entity_id))
+
+            entity_ids[subscription_type].add(entity_id)
+
+        return entity_ids
+
+    def lookup_updates(self, index, entity_ids, key=None):
+        updates = [index[i] for i in sorted(set(entity_ids)) if i in index]
+
+        if key:
+            updates = sorted(updates, key=key)
+
+        return updates
 
     def find_bill_action_updates(self, bill_ids):
 
@@ -180,8 +820,9 @@ class Command(BaseCommand):
               bill.identifier AS bill_identifier,
               bill.description AS bill_description,
               action.description AS action_description,
-              action.date AS action_date
-            FROM new_action AS new
+              action.date AS action_date,
+              bill.ocd_id AS bill_id
+            FROM {new_action} AS new
             JOIN councilmatic_core_bill AS bill
               ON new.bill_id = bill.ocd_id
             JOIN councilmatic_core_action AS action
@@ -190,9 +831,9 @@ class Command(BaseCommand):
         '''
 
         cursor = connection.cursor()
-        cursor.execute(new_actions, [tuple(bill_ids)])
+        cursor.execute(new_actions.format(**self.sources), [tuple(bill_ids)])
 
-        bill_action_updates = []
+        bill_action_updates = {}
 
         for row in cursor:
 
@@ -206,71 +847,134 @@ class Command(BaseCommand):
                 'date': row[4],
             }
 
-            bill_action_updates.append((bill, action))
+            bill_action_updates[row[5]] = (bill, action)
 
         return bill_action_updates
 
     def find_bill_search_updates(self, search_params):
+        # Matches each distinct search against only the bills that are new in
+        # this run, returning the bills it matches keyed by the search's
+        # canonical key. The cost depends on the number of new bills and
+        # distinct searches rather than the size of the index.
 
         if not haystack_url:
             self.stdout.write(self.style.ERROR('Solr is not configured so no search notifications will be sent'))
-            return []
+            return {}
 
-        search_updates = []
+        new_bills = self.cached(self.find_new_bills)
 
-        cursor = connection.cursor()
+        if not new_bills:
+            return {}
 
-        for params in search_params:
+        searches = {canonical_search(params): params for params in search_params}
 
-            term = params['term'].strip()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=solr_concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
 
-            if not term:
-                term = '*:*'
+        search = lambda params: self.search_new_bills(session, params, list(new_bills))
 
-            query_params = {
-                'q': term,
-                'fq': [],
-                'wt': 'json'
-            }
+        with ThreadPoolExecutor(max_workers=solr_concurrency) as executor:
+            search_results = dict(zip(searches.keys(),
+                                      executor.map(search, searches.values())))
+
+        session.close()
 
-            for facet, values in params['facets'].items():
-                for value in values:
-                    query_params['fq'].append('{0}:{1}'.format(facet, value))
+        search_updates = {}
 
-            results = requests.get('{}/select'.format(haystack_url), params=query_params)
+        for key, ocd_ids in search_results.items():
+            bills = [new_bills[ocd_id] for ocd_id in sorted(ocd_ids)
+                     if ocd_id in new_bills]
+
+            if bills:
+                search_updates[key] = bills
+
+        return search_updates
+
+    def search_new_bills(self, session, params, new_bill_ids):
+        # Called from worker threads, so this must not touch the database. A
+        # search that fails is logged and treated as matching nothing, rather
+        # than failing the run for everyone.
+
+        term = (params['term'] or '').strip()
+
+        if not term:
+            term = '*:*'
+
+        query_params = {
+            'q': term,
+            # Only consider documents for bills that are new in this run, and
+            # ask for all of them so that none fall past the default row limit.
+            'fq': ['{{!terms f=django_id}}{}'.format(','.join(new_bill_ids))],
+            'rows': len(new_bill_ids),
+            'fl': 'ocd_id',
+            'wt': 'json'
+        }
+
+        for facet, values in params['facets'].items():
+            for value in values:
+                query_params['fq'].append('{0}:{1}'.format(facet, value))
+
+        # POST, since the filter on new bills can be too long for a URL.
+        start = time.perf_counter()
+
+        try:
+            results = session.post('{}/select'.format(haystack_url),
+                                   data=query_params,
+                                   timeout=solr_timeout)
+            results.raise_for_status()
+
+            docs = results.json()['response']['docs']
+
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning('Solr search %s failed: %s', canonical_search(params), e)
+            self.results.record_solr(time.perf_counter() - start, error=e)
+
+            return ()
+
+        self.results.record_solr(time.perf_counter() - start)
+
+        return tuple(r['ocd_id'] for r in docs)
+
+    def find_new_bills(self):
+        new_bills = '''
+            SELECT
+              bill.ocd_id,
+              bill.slug AS bill_slug,
+              bill.identifier AS bill_identifier,
+              bill.description AS bill_description
+            FROM {new_bill} AS new
+            JOIN councilmatic_core_bill AS bill
+              ON new.ocd_id = bill.ocd_id
+            ORDER BY bill.ocd_id
+        '''
 
-            ocd_ids = tuple(r['ocd_id'] for r in results.json()['response']['docs'])
+        cursor = connection.cursor()
+        cursor.execute(new_bills.format(**self.sources))
 
+        bills = OrderedDict()
 
-            new_bills = '''
-                SELECT DISTINCT ON (bill.ocd_id)
-                  bill.slug AS bill_slug,
-                  bill.identifier AS bill_identifier,
-                  bill.description AS bill_description
-                FROM new_bill AS new
-                JOIN councilmatic_core_bill AS bill
-                  ON new.ocd_id = bill.ocd_id
-                WHERE new.ocd_id IN %s
-            '''
+        for row in cursor:
+            bills[row[0]] = {
+                'slug': row[1],
+                'identifier': row[2],
+                'description': row[3]
+            }
 
-            if ocd_ids:
-                cursor.execute(new_bills, [ocd_ids])
+        return bills
 
-                bills = []
+    def lookup_search_updates(self, index, search_params):
+        search_updates = []
 
-                for row in cursor:
-                    bill = {
-                        'slug': row[0],
-                        'identifier': row[1],
-                        'description': row[2]
-                    }
-                    bills.append(bill)
+        for params in search_params:
+            bills = index.get(canonical_search(params))
 
-                if bills:
-                    search_updates.append({
-                        'params': params,
-                        'bills': bills
-                    })
+            if bills:
+                search_updates.append({
+                    'params': params,
+                    'bills': bills
+                })
 
         return search_updates
 
@@ -284,8 +988,9 @@ class Command(BaseCommand):
               person.slug,
               bill.identifier,
               bill.slug,
-              bill.description
-            FROM new_sponsorship AS new
+              bill.description,
+              person.ocd_id
+            FROM {new_sponsorship} AS new
             JOIN councilmatic_core_person AS person
               ON new.person_id = person.ocd_id
             JOIN councilmatic_core_bill AS bill
@@ -315,11 +1020,14 @@ class Command(BaseCommand):
         # '''
 
         person_updates = []
+        person_ids_by_slug = {}
 
         cursor = connection.cursor()
-        cursor.execute(new_sponsorships, [tuple(person_ids)])
+        cursor.execute(new_sponsorships.format(**self.sources), [tuple(person_ids)])
 
         for row in cursor:
+            person_ids_by_slug[row[1]] = row[5]
+
             person = {
                 'name': row[0],
                 'slug': row[1],
@@ -355,7 +1063,7 @@ class Command(BaseCommand):
         # not sending notifications for when a bill that a person sponsored has
         # an action on it.
 
-        update_groups = []
+        update_groups = {}
 
         outer_grouper = lambda x: x[0]['slug']
         person_updates = sorted(person_updates, key=outer_grouper)
@@ -378,92 +1086,89 @@ class Command(BaseCommand):
                     except KeyError:
                         bill_group[update_type]['bills'] = [bill]
 
-            update_groups.append(bill_group)
+            update_groups[person_ids_by_slug[slug]] = bill_group
 
         return update_groups
 
     def find_committee_action_updates(self, committee_ids):
-        # New actions taken by a committee on a bill
+        # New actions taken by a committee on a bill. Rows come back one per
+        # committee and bill, in the order they are shown, with the bill's
+        # actions aggregated newest first, so they only need to be
+        # collected per committee.
 
         new_actions = '''
-            SELECT DISTINCT ON (committee.ocd_id, bill.ocd_id, action.id)
+            SELECT
+              committee.ocd_id,
               committee.name,
               committee.slug,
               bill.identifier,
               bill.slug,
               bill.description,
-              action.description,
-              action.date,
-              action.order
+              array_agg(action.description ORDER BY action.order DESC, action.id),
+              array_agg(action.date ORDER BY action.order DESC, action.id)
             FROM councilmatic_core_organization AS committee
             JOIN councilmatic_core_action AS action
               ON committee.ocd_id = action.organization_id
             JOIN councilmatic_core_bill AS bill
               ON action.bill_id = bill.ocd_id
-            JOIN new_action AS new
-              ON bill.ocd_id = new.bill_id
             WHERE committee.ocd_id IN %s
-            ORDER BY committee.ocd_id,
+              AND bill.ocd_id IN (SELECT bill_id FROM {new_action} AS new)
+            GROUP BY committee.ocd_id,
+                     committee.name,
+                     committee.slug,
                      bill.ocd_id,
-                     action.id,
-                     action.order DESC
+                     bill.identifier,
+                     bill.slug,
+                     bill.description
+            ORDER BY committee.ocd_id,
+                     bill.slug,
+                     bill.ocd_id
         '''
 
         cursor = connection.cursor()
-        cursor.execute(new_actions, [tuple(committee_ids)])
-
-        committee_updates = []
+        cursor.execute(new_actions.format(**self.sources), [tuple(committee_ids)])
 
-        outer_grouper = lambda x: x[1]
-        inner_grouper = lambda x: x[3]
-        groups = sorted(cursor, key=outer_grouper)
+        committee_updates = {}
 
-        for committee_slug, group in itertools.groupby(groups, key=outer_grouper):
+        for committee_id, name, slug, identifier, bill_slug, description, action_descriptions, action_dates in cursor:
 
-            group = sorted(group, key=inner_grouper)
-
-            committee_group = {
-                'name': group[0][0],
-                'slug': group[0][1],
-                'bills': []
-            }
-
-
-            for bill_slug, bill_group in itertools.groupby(group, key=inner_grouper):
-
-                bill_group = list(bill_group)
-
-                bill = {
-                    'identifier': bill_group[0][2],
-                    'slug': bill_group[0][3],
-                    'description': bill_group[0][4],
-                    'actions': []
+            try:
+                committee_group = committee_updates[committee_id]
+            except KeyError:
+                committee_group = committee_updates[committee_id] = {
+                    'name': name,
+                    'slug': slug,
+                    'bills': []
                 }
 
+            bill = {
+                'identifier': identifier,
+                'slug': bill_slug,
+                'description': description,
+                'actions': [{'description': d, 'date': date}
+                            for d, date in zip(action_descriptions, action_dates)]
+            }
 
-                for row in sorted(bill_group, key=lambda x: x[7], reverse=True):
-                    action = {
-                        'description': row[5],
-                        'date': row[6]
-                    }
-
-                    bill['actions'].append(action)
-
-                committee_group['bills'].append(bill)
-
-            committee_updates.append(committee_group)
+            committee_group['bills'].append(bill)
 
         return committee_updates
 
     def find_committee_event_updates(self, committee_ids):
+        # Only the event fields the templates show are fetched. Rows come
+        # back latest first, and keep that order within each committee.
+
         new_events = '''
             SELECT * FROM (
             SELECT DISTINCT ON (committee.ocd_id, event.ocd_id)
-              committee.name,
-              committee.slug,
-              event.*
+              committee.ocd_id AS committee_id,
+              committee.name AS committee_name,
+              committee.slug AS committee_slug,
+              event.name,
+              event.slug,
+              event.start_time,
+              event.description
             FROM councilmatic_core_event AS event
-            JOIN new_event AS new
+            JOIN {new_event} AS new
               ON event.ocd_id = new.ocd_id
             JOIN councilmatic_core_eventparticipant AS p
               ON event.ocd_id = p.event_id
@@ -474,36 +1179,27 @@ class Command(BaseCommand):
             ORDER BY committee.ocd_id,
                      event.ocd_id
             ) AS events
-            ORDER BY events.start_time DESC
+            ORDER BY events.start_time DESC,
+                     events.slug
         '''
 
         cursor = connection.cursor()
-        cursor.execute(new_events, [tuple(committee_ids)])
-        columns = [c[0] for c in cursor.description]
-
-        updates = []
+        cursor.execute(new_events.format(**self.sources), [tuple(committee_ids)])
 
-        grouper = lambda x: x[1]
-        event_groups = sorted(cursor, key=grouper)
+        updates = {}
 
-        for slug, group in itertools.groupby(event_groups, key=grouper):
-            group = list(group)
-
-            committee = {
-                'name': group[0][0],
-                'slug': group[0][1],
-                'events': []
-            }
+        for committee_id, committee_name, committee_slug, name, slug, start_time, description in cursor:
 
-            for row in group:
-                event = dict(zip(columns[2:], row[2:]))
-                committee['events'].append(event)
-
-            committee['events'] = sorted(committee['events'],
-                                         key=lambda x: x['start_time'],
-                                         reverse=True)
+            try:
+                committee = updates[committee_id]
+            except KeyError:
+                committee = updates[committee_id] = {
+                    'name': committee_name,
+                    'slug': committee_slug,
+                    'events': []
+                }
 
-            updates.append(committee)
+            committee['events'].append(CommitteeEvent(name, slug, start_time, description))
 
         return updates
 
@@ -519,7 +1215,7 @@ class Command(BaseCommand):
               event.location_name,
               event.slug
             FROM councilmatic_core_event AS event
-            JOIN new_event AS new
+            JOIN {new_event} AS new
               ON event.ocd_id = new.ocd_id
             WHERE event.start_time > NOW()
             ) AS events
@@ -527,7 +1223,7 @@ class Command(BaseCommand):
         '''
 
         cursor = connection.cursor()
-        cursor.execute(new_events)
+        cursor.execute(new_events.format(**self.sources))
         columns = [c[0] for c in cursor.description]
 
         return [dict(zip(columns, r)) for r in cursor]
@@ -544,7 +1240,7 @@ class Command(BaseCommand):
               event.location_name,
               event.slug
             FROM councilmatic_core_event AS event
-            JOIN change_event AS change
+            JOIN {change_event} AS change
               ON event.ocd_id = change.ocd_id
             WHERE event.start_time > NOW()
             ) AS events
@@ -552,21 +1248,102 @@ class Command(BaseCommand):
         '''
 
         cursor = connection.cursor()
-        cursor.execute(new_events)
+        cursor.execute(new_events.format(**self.sources))
         columns = [c[0] for c in cursor.description]
 
         return [dict(zip(columns, r)) for r in cursor]
 
-@django_rq.job
-def send_notification_email(user_id=None,
-                            user_email=None,
-                            bill_action_updates=[],
-                            bill_search_updates=[],
-                            person_updates=[],
-                            committee_action_updates=[],
-                            committee_event_updates=[],
-                            updated_events=[],
-                            new_events=[]):
+def shared_payload_key(run_id):
+    return 'notifications:run:{}'.format(run_id)
+
+def digest_fields(update_keys):
+    for section, keys in update_keys.items():
+        if section == 'bill_search_updates':
+            keys = [field for params, field in keys]
+
+        for field in keys:
+            yield field
+
+def digest_hash(digest):
+    # Identifies what a digest says, however it is queued. Serialized with
+    # sorted keys, so that a retry in another process, with another hash
+    # seed and so another dict order, gets the same hash.
+    content = json.dumps(digest.sections(), sort_keys=True, default=json_default)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def delivery_key(digest):
+    run_id, digest_hash = digest.delivery
+    return digest.user_id, run_id, digest_hash
+
+def delivered_digests(digests):
+    # The delivery keys of the digests the ledger records as sent, found
+    # with one query. Digests queued without a delivery key are never
+    # considered sent.
+
+    keys = set(delivery_key(d) for d in digests if d.delivery)
+
+    if not keys:
+        return set()
+
+    sent = NotificationDelivery.objects.filter(user_id__in=set(k[0] for k in keys),
+                                               run_id__in=set(k[1] for k in keys))\
+                                       .values_list('user_id', 'run_id', 'digest_hash')
+
+    return keys & set(sent)
+
+def mark_delivered(digest):
+    if digest.delivery:
+        user_id, run_id, digest_hash = delivery_key(digest)
+
+        NotificationDelivery.objects.get_or_create(user_id=user_id,
+                                                   run_id=run_id,
+                                                   digest_hash=digest_hash)
+
+def load_digest(digest):
+    # Rebuilds a digest queued with --shared-payload from the updates stored
+    # for its run. Digests queued with their updates are returned as is.
+
+    if digest.run_id is None:
+        return digest
+
+    update_keys = digest.update_keys
+    fields = sorted(set(digest_fields(update_keys)))
+
+    updates = {}
+
+    if fields:
+        redis = django_rq.get_connection()
+        values = redis.hmget(shared_payload_key(digest.run_id), fields)
+
+        if None in values:
+            raise ValueError('Updates for notification run {} have expired'.format(digest.run_id))
+
+        updates = {f: pickle.loads(v) for f, v in zip(fields, values)}
+
+    loaded = {}
+
+    for section, keys in update_keys.items():
+        if section == 'bill_search_updates':
+            loaded[section] = [{'params': params, 'bills': updates[field]}
+                               for params, field in keys]
+
+        elif section in ('new_events', 'updated_events'):
+            loaded[section] = updates[keys[0]] if keys else []
+
+        else:
+            loaded[section] = [updates[field] for field in keys]
+
+    return Digest(digest.user_id, digest.user_email, delivery=digest.delivery, **loaded)
+
+def build_notification_email(user_id=None,
+                             user_email=None,
+                             bill_action_updates=[],
+                             bill_search_updates=[],
+                             person_updates=[],
+                             committee_action_updates=[],
+                             committee_event_updates=[],
+                             updated_events=[],
+                             new_events=[]):
 
     context = {
         # 'user': user,
@@ -583,10 +1360,10 @@ def send_notification_email(user_id=None,
 
     html = "notifications_email.html"
     txt = "notifications_email.txt"
-    html_template = get_template(html)
-    text_template = get_template(txt)
-    html_content = html_template.render(context)
-    text_content = text_template.render(context)
+
+    with get_instrumentation().timer('render'):
+        html_content = render_notification(html, context)
+        text_content = render_notification(txt, context)
     subject = '{0} Updates!'.format(settings.SITE_META['site_name'])
 
     msg = EmailMultiAlternatives(subject,
@@ -595,4 +1372,115 @@ def send_notification_email(user_id=None,
                                  [user_email])
 
     msg.attach_alternative(html_content, 'text/html')
-    msg.send()
+
+    return msg
+
+def digest_email(digest):
+    digest = load_digest(digest)
+    return build_notification_email(digest.user_id, digest.user_email, **digest.sections())
+
+@django_rq.job
+def send_notification_email(digest=None, **queued_as_dict):
+    digest = Digest.from_job(digest or queued_as_dict)
+
+    # A retried job does nothing if its digest went out the first time.
+    if delivered_digests([digest]):
+        return
+
+    msg = digest_email(digest)
+
+    with get_instrumentation().timer('send'):
+        msg.send()
+
+    mark_delivered(digest)
+
+@django_rq.job
+def send_notification_emails(digests):
+    # Sends a batch of digests over as few mail connections as possible,
+    # rather than opening a new connection for every recipient.
+
+    # Digests already sent by an earlier attempt at this job are skipped, and
+    # each one is marked as it goes out, so a retry resumes where this left
+    # off.
+    digests = [Digest.from_job(d) for d in digests]
+    delivered = delivered_digests(digests)
+    digests = [d for d in digests if not d.delivery or delivery_key(d) not in delivered]
+
+    # Digests the mail server refused, by user ID, returned as the job's
+    # result.
+    failed = {}
+
+    mail_connection = None
+    sent_on_connection = 0
+
+    try:
+        for digest in digests:
+            msg = digest_email(digest)
+
+            if mail_connection is None or sent_on_connection >= messages_per_connection:
+                if mail_connection is not None:
+                    mail_connection.close()
+
+                mail_connection = get_connection()
+                mail_connection.open()
+                sent_on_connection = 0
+
+            with get_instrumentation().timer('send'):
+                try:
+                    mail_connection.send_messages([msg])
+
+                except OSError as e:
+                    if not connection_lost(e):
+                        # A refused recipient or message fails only its own
+                        # digest. Sending it again would fail the same way.
+                        logger.error('Notification email to user %s refused: %s', digest.user_id, e)
+                        failed[digest.user_id] = str(e)
+                        continue
+
+                    # Reconnect and try once more. If that fails too, the job
+                    # fails and RQ keeps it around to be retried.
+                    mail_connection.close()
+                    mail_connection = get_connection()
+                    mail_connection.open()
+                    sent_on_connection = 0
+
+                    mail_connection.send_messages([msg])
+
+            sent_on_connection += 1
+
+            mark_delivered(digest)
+
+    finally:
+        if mail_connection is not None:
+            mail_connection.close()
+
+    return failed
+
+def connection_lost(error):
+    # SMTP errors are OSErrors too, but only a disconnection says anything
+    # about the connection rather than the message.
+    return isinstance(error, smtplib.SMTPServerDisconnected) or \
+        not isinstance(error, smtplib.SMTPException)
+
+def run_notifications(**options):
+    # Runs send_notifications with the given options, returning its
+    # RunResults rather than text, with what each user was sent.
+
+    command = Command()
+    command.keep_user_results = True
+    call_command(command, stdout=StringIO(), **options)
+
+    return command.results
+
+@django_rq.job
+def send_user_notifications(username):
+    # Sends one user their notifications from a worker, returning how many
+    # updates of each kind they were sent. Used by the send-notifications
+    # view, which looks the result up by job ID.
+
+    results = run_notifications(users=username)
+
+    return {
+        'email_sent': bool(results.users),
+        'sections': results.users[0]['sections'] if results.users else {},
+    }
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Incremental runs find updates by when they were last touched, rather than
+# in the staging tables.
+UPDATED_AT_TABLES = (
+    'councilmatic_core_action',
+    'councilmatic_core_bill',
+    'councilmatic_core_event',
+    'councilmatic_core_sponsorship',
+)
+
+# The tables belong to councilmatic_core, and nothing here orders this after
+# the migration of its that adds updated_at, so on a fresh database the
+# column may not exist yet.
+CREATE_INDEX = '''
+    DO $$
+    BEGIN
+      IF EXISTS (SELECT 1
+                 FROM information_schema.columns
+                 WHERE table_name = '{0}'
+                   AND column_name = 'updated_at') THEN
+        CREATE INDEX IF NOT EXISTS {0}_updated_at_idx ON {0} (updated_at);
+      END IF;
+    END
+    $$
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0005_auto_20161121_1208'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sent_until', models.DateTimeField(db_index=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='subscription_watermark', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ] + [
+        migrations.RunSQL(
+            CREATE_INDEX.format(table),
+            'DROP INDEX IF EXISTS {0}_updated_at_idx'.format(table),
+        )
+        for table in UPDATED_AT_TABLES
+    ]
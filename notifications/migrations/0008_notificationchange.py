@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Records rows the import adds to the councilmatic tables in
+# notifications_notificationchange and wakes up anything listening. The
+# triggers that call it are installed by consume_notification_changes.
+RECORD_CHANGE = '''
+    CREATE OR REPLACE FUNCTION notifications_record_change() RETURNS trigger AS $$
+    BEGIN
+      IF TG_TABLE_NAME = 'councilmatic_core_action' THEN
+        INSERT INTO notifications_notificationchange (source, object_id, created_at)
+        VALUES ('new_action', NEW.bill_id, now());
+      ELSIF TG_TABLE_NAME = 'councilmatic_core_sponsorship' THEN
+        INSERT INTO notifications_notificationchange (source, object_id, person_id, created_at)
+        VALUES ('new_sponsorship', NEW.bill_id, NEW.person_id, now());
+      ELSIF TG_TABLE_NAME = 'councilmatic_core_bill' THEN
+        INSERT INTO notifications_notificationchange (source, object_id, created_at)
+        VALUES ('new_bill', NEW.ocd_id, now());
+      ELSIF TG_OP = 'INSERT' THEN
+        INSERT INTO notifications_notificationchange (source, object_id, created_at)
+        VALUES ('new_event', NEW.ocd_id, now());
+      ELSE
+        INSERT INTO notifications_notificationchange (source, object_id, created_at)
+        VALUES ('change_event', NEW.ocd_id, now());
+      END IF;
+
+      PERFORM pg_notify('notifications_changes', '');
+
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0007_notificationdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=20)),
+                ('object_id', models.CharField(max_length=100)),
+                ('person_id', models.CharField(max_length=100, null=True)),
+                ('claim', models.CharField(db_index=True, max_length=32, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunSQL(
+            RECORD_CHANGE,
+            'DROP FUNCTION IF EXISTS notifications_record_change() CASCADE',
+        ),
+    ]
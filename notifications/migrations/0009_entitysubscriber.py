@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Subscription tables, with the column holding the followed entity and the
+# type it is indexed under in notifications_entitysubscriber.
+SUBSCRIPTION_TABLES = (
+    ('notifications_billactionsubscription', 'bill_id', 'bill_action'),
+    ('notifications_committeeactionsubscription', 'committee_id', 'committee_action'),
+    ('notifications_committeeeventsubscription', 'committee_id', 'committee_event'),
+    ('notifications_personsubscription', 'person_id', 'person'),
+)
+
+# Duplicates left by get_or_create races have to go before the unique
+# constraints can be added. The oldest subscription is kept.
+DELETE_DUPLICATES = '''
+    DELETE FROM {0} AS dupe
+    USING {0} AS kept
+    WHERE dupe.user_id = kept.user_id
+      AND dupe.{1} IS NOT DISTINCT FROM kept.{1}
+      AND dupe.id > kept.id
+'''
+
+INDEX_SUBSCRIBERS = '''
+    INSERT INTO notifications_entitysubscriber (entity_type, entity_id, user_id)
+    SELECT DISTINCT '{2}', {1}, user_id
+    FROM {0}
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0008_notificationchange'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            DELETE_DUPLICATES.format(table, column),
+            migrations.RunSQL.noop,
+        )
+        for table, column, entity_type in SUBSCRIPTION_TABLES
+    ] + [
+        migrations.RunSQL(
+            DELETE_DUPLICATES.format('notifications_eventssubscription', 'user_id'),
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='billactionsubscription',
+            unique_together=set([('user', 'bill')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='committeeactionsubscription',
+            unique_together=set([('user', 'committee')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='committeeeventsubscription',
+            unique_together=set([('user', 'committee')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='personsubscription',
+            unique_together=set([('user', 'person')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventssubscription',
+            unique_together=set([('user',)]),
+        ),
+        migrations.CreateModel(
+            name='EntitySubscriber',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity_type', models.CharField(max_length=20)),
+                ('entity_id', models.CharField(max_length=100)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='followed_entities', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='entitysubscriber',
+            unique_together=set([('entity_type', 'entity_id', 'user')]),
+        ),
+    ] + [
+        migrations.RunSQL(
+            INDEX_SUBSCRIBERS.format(table, column, entity_type),
+            migrations.RunSQL.noop,
+        )
+        for table, column, entity_type in SUBSCRIPTION_TABLES
+    ]
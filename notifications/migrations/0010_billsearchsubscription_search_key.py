@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Copies of notifications.utils.canonical_search and search_hash as they were
+# when this migration was written, so that later changes to them cannot
+# change what it does.
+
+def canonical_search(search_params):
+    term = (search_params.get('term') or '').strip()
+
+    facets = {facet: sorted(values)
+              for facet, values in (search_params.get('facets') or {}).items()
+              if values}
+
+    return json.dumps({'term': term, 'facets': facets}, sort_keys=True)
+
+
+def search_hash(search_params):
+    return hashlib.sha1(canonical_search(search_params).encode('utf-8')).hexdigest()
+
+
+# Saved searches that differ only in the order of their facets have the same
+# key. The oldest of each is kept.
+DELETE_DUPLICATES = '''
+    DELETE FROM notifications_billsearchsubscription AS dupe
+    USING notifications_billsearchsubscription AS kept
+    WHERE dupe.user_id = kept.user_id
+      AND dupe.search_key = kept.search_key
+      AND dupe.id > kept.id
+'''
+
+
+def add_search_keys(apps, schema_editor):
+    BillSearchSubscription = apps.get_model('notifications', 'BillSearchSubscription')
+
+    subscriptions = BillSearchSubscription.objects.filter(search_params__isnull=False).only('search_params')
+
+    for subscription in subscriptions.iterator():
+        BillSearchSubscription.objects.filter(id=subscription.id) \
+                                      .update(search_key=search_hash(subscription.search_params))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0009_entitysubscriber'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billsearchsubscription',
+            name='search_key',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.RunPython(add_search_keys, migrations.RunPython.noop),
+        migrations.RunSQL(DELETE_DUPLICATES, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+import django.contrib.postgres.fields.jsonb
+
+
+# Separate from adding the keys, since Postgres will not alter a table with
+# updates to it pending in the same transaction.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0010_billsearchsubscription_search_key'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='billsearchsubscription',
+            unique_together=set([('user', 'search_key')]),
+        ),
+        migrations.AlterField(
+            model_name='billsearchsubscription',
+            name='search_params',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+    ]
@@ -1,8 +1,15 @@
+import uuid
+
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from django.contrib.auth.models import User
 from councilmatic_core.models import Bill, Organization, Person
 
+from notifications.utils import search_hash
+
 from django.contrib.postgres.fields import JSONField
 
 
@@ -32,22 +39,168 @@ class PersonSubscription(Subscription):
     # related_name lets us go from the user to their committee member subscriptions
     person = models.ForeignKey(Person, related_name = 'subscriptions')
 
+    class Meta:
+        unique_together = ('user', 'person')
+
 class CommitteeActionSubscription(Subscription):
     committee = models.ForeignKey(Organization, related_name = 'subscriptions_actions')
 
+    class Meta:
+        unique_together = ('user', 'committee')
+
 class CommitteeEventSubscription(Subscription):
     committee = models.ForeignKey(Organization, related_name = 'subscriptions_events')
 
+    class Meta:
+        unique_together = ('user', 'committee')
+
 class BillSearchSubscription(Subscription):
-    search_params = JSONField(db_index=True, null=True)
+    search_params = JSONField(null=True)
+    # Hash of the canonical form of search_params, so that the same search
+    # saved with its facets in another order is found, and saved only once.
+    search_key = models.CharField(max_length=40, null=True)
+
+    class Meta:
+        unique_together = ('user', 'search_key')
+
+    def save(self, *args, **kwargs):
+        if self.search_params is not None:
+            self.search_key = search_hash(self.search_params)
+
+        super(BillSearchSubscription, self).save(*args, **kwargs)
 
 class BillActionSubscription(Subscription):
     bill = models.ForeignKey(Bill, related_name = 'subscriptions')
 
+    class Meta:
+        unique_together = ('user', 'bill')
+
 class EventsSubscription(Subscription):
     # This subscribes to all recent/upcoming events as per https://github.com/datamade/nyc-councilmatic/issues/175
     # XXX: not implemented yet
-    pass
+
+    class Meta:
+        unique_together = ('user',)
+
+class EntitySubscriber(models.Model):
+    # Who follows a bill, person or committee, so that the users affected by
+    # a change can be found without going through every subscription table.
+    # Kept in step with the subscriptions by the receivers below.
+    entity_type = models.CharField(max_length=20)
+    entity_id = models.CharField(max_length=100)
+    user = models.ForeignKey(User, related_name='followed_entities')
+
+    class Meta:
+        unique_together = ('entity_type', 'entity_id', 'user')
+
+# The entity type each subscription model is indexed under, and the field
+# holding the followed entity's ID.
+SUBSCRIBER_INDEX = {
+    BillActionSubscription: ('bill_action', 'bill_id'),
+    CommitteeActionSubscription: ('committee_action', 'committee_id'),
+    CommitteeEventSubscription: ('committee_event', 'committee_id'),
+    PersonSubscription: ('person', 'person_id'),
+}
+
+def index_subscribers(model, subscriptions):
+    # For subscriptions created without sending post_save, e.g. with
+    # bulk_create.
+    entity_type, field = SUBSCRIBER_INDEX[model]
+
+    EntitySubscriber.objects.bulk_create([
+        EntitySubscriber(entity_type=entity_type,
+                         entity_id=getattr(s, field),
+                         user_id=s.user_id)
+        for s in subscriptions
+    ])
+
+def unindex_subscribers(model, user_id, entity_ids):
+    # For subscriptions deleted without sending post_delete.
+    entity_type, field = SUBSCRIBER_INDEX[model]
+
+    EntitySubscriber.objects.filter(entity_type=entity_type,
+                                    entity_id__in=entity_ids,
+                                    user_id=user_id).delete()
+
+@receiver(post_save)
+def index_subscriber(sender, instance, **kwargs):
+    if sender in SUBSCRIBER_INDEX:
+        entity_type, field = SUBSCRIBER_INDEX[sender]
+
+        EntitySubscriber.objects.get_or_create(entity_type=entity_type,
+                                               entity_id=getattr(instance, field),
+                                               user_id=instance.user_id)
+
+@receiver(post_delete)
+def unindex_subscriber(sender, instance, **kwargs):
+    if sender in SUBSCRIBER_INDEX:
+        entity_type, field = SUBSCRIBER_INDEX[sender]
+
+        EntitySubscriber.objects.filter(entity_type=entity_type,
+                                        entity_id=getattr(instance, field),
+                                        user_id=instance.user_id).delete()
+
+# What is cached about a user's subscriptions is keyed on a version that
+# changes with them. A view that read the version before a change and
+# caches what it found after writes under the old version, where nothing
+# will look. Versions are random rather than counted, so one evicted and
+# made again cannot bring back what was cached under an earlier one.
+
+def subscriptions_version_key(user_id):
+    return 'notifications:subscriptions_version:{}'.format(user_id)
+
+def subscriptions_version(user_id):
+    key = subscriptions_version_key(user_id)
+    version = cache.get(key)
+
+    if version is None:
+        version = uuid.uuid4().hex
+
+        if not cache.add(key, version, None):
+            version = cache.get(key)
+
+    return version
+
+def subscriptions_cache_key(user_id):
+    return 'notifications:subscriptions:{0}:{1}'.format(user_id, subscriptions_version(user_id))
+
+def subscription_status_cache_key(user_id):
+    return 'notifications:subscription_status:{0}:{1}'.format(user_id, subscriptions_version(user_id))
+
+def forget_subscriptions(user_id):
+    # For subscriptions changed without sending post_save or post_delete.
+    cache.set(subscriptions_version_key(user_id), uuid.uuid4().hex, None)
+
+@receiver(post_save)
+@receiver(post_delete)
+def subscriptions_changed(sender, instance, **kwargs):
+    if issubclass(sender, Subscription):
+        forget_subscriptions(instance.user_id)
+
+class SubscriptionWatermark(models.Model):
+    # How far a user has been sent updates by incremental notification runs
+    user = models.OneToOneField(User, related_name='subscription_watermark')
+    sent_until = models.DateTimeField(db_index=True)
+
+class NotificationDelivery(models.Model):
+    # A digest that has been sent, so retried runs and jobs can skip it
+    user = models.ForeignKey(User, related_name='notification_deliveries')
+    run_id = models.CharField(max_length=64)
+    digest_hash = models.CharField(max_length=40)
+    sent_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'run_id', 'digest_hash')
+
+class NotificationChange(models.Model):
+    # A change recorded by the triggers consume_notification_changes
+    # installs, waiting to be sent to the users it affects. source names the
+    # staging table the change stands in for.
+    source = models.CharField(max_length=20)
+    object_id = models.CharField(max_length=100)
+    person_id = models.CharField(max_length=100, null=True)
+    claim = models.CharField(max_length=32, null=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
 class SubscriptionProfile(models.Model):
     user = models.OneToOneField(User)
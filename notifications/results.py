@@ -0,0 +1,155 @@
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date
+
+from notifications.instrumentation import Instrumentation
+
+
+def json_default(value):
+    return value.isoformat() if isinstance(value, date) else None
+
+
+class RunResults(object):
+    # What a send_notifications run did: how many users it looked at and
+    # queued digests for, what each user was sent and in which job, and how
+    # long the finders and Solr took. Timings also go to the run's
+    # instrumentation, which has the whole breakdown when it records.
+    #
+    # Only totals are kept by default, so memory does not grow with the
+    # number of subscribers. Given a path, the per-user records are written
+    # to it as JSON Lines as they come in, followed by a line with the
+    # summary. With keep_users, they are kept in memory instead, along with
+    # the IDs of the jobs, which is only sensible for a few users.
+
+    def __init__(self, run_id, jsonl_path=None, instrumentation=None, keep_users=False):
+        self.run_id = run_id
+        self.jsonl_path = jsonl_path
+        self.instrumentation = instrumentation or Instrumentation()
+        self.keep_users = keep_users
+
+        self.stats = Counter()
+        self.users = []
+        self.job_ids = set()
+        self.jobs = 0
+        self.section_updates = Counter()
+
+        self.finder_calls = Counter()
+        self.finder_seconds = Counter()
+        self.solr_seconds = []
+        self.solr_errors = []
+
+        self.output = None
+
+    def start(self):
+        if self.jsonl_path:
+            open(self.jsonl_path, 'w').close()
+
+    def for_shard(self):
+        # Per-user records made in another process have to be handed back
+        # and merged, so a shard starts from empty ones.
+        return RunResults(self.run_id,
+                          self.jsonl_path,
+                          self.instrumentation.for_shard(),
+                          self.keep_users)
+
+    def merge(self, shard_results):
+        self.users.extend(shard_results.users)
+        self.job_ids.update(shard_results.job_ids)
+        self.jobs += shard_results.jobs
+        self.section_updates.update(shard_results.section_updates)
+        self.finder_calls.update(shard_results.finder_calls)
+        self.finder_seconds.update(shard_results.finder_seconds)
+        self.solr_seconds.extend(shard_results.solr_seconds)
+        self.solr_errors.extend(shard_results.solr_errors)
+        self.instrumentation.merge(shard_results.instrumentation)
+
+    @contextmanager
+    def time_finder(self, name):
+        start = time.perf_counter()
+
+        try:
+            with self.instrumentation.timer('finder.{}'.format(name)):
+                yield
+        finally:
+            self.finder_calls[name] += 1
+            self.finder_seconds[name] += time.perf_counter() - start
+
+    def record_solr(self, seconds, error=None):
+        # Called from worker threads. Appending to a list is atomic.
+        self.solr_seconds.append(seconds)
+        self.instrumentation.observe('solr', seconds)
+
+        if error is not None:
+            self.solr_errors.append(str(error))
+
+    def record_users(self, sections, job_ids):
+        # sections are (user ID, updates in each section) pairs for digests
+        # that were built, and job_ids the jobs they were queued in by user.
+        # A digest with no job was already delivered. Jobs are never shared
+        # between calls.
+
+        self.jobs += len(set(job_ids.values()))
+
+        for user_id, counts in sections:
+            self.section_updates.update(counts)
+
+        if not (self.jsonl_path or self.keep_users):
+            return
+
+        records = [{'user_id': user_id,
+                    'sections': counts,
+                    'job_id': job_ids.get(user_id)}
+                   for user_id, counts in sections]
+
+        if self.jsonl_path:
+            # Shards append to the same file, so each batch goes out in a
+            # single write to keep their lines from interleaving.
+            lines = ''.join(json.dumps(r) + '\n' for r in records)
+
+            fd = os.open(self.jsonl_path, os.O_WRONLY | os.O_APPEND)
+
+            try:
+                os.write(fd, lines.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+        else:
+            self.users.extend(records)
+            self.job_ids.update(job_ids.values())
+
+    def summary(self):
+        summary = {
+            'run_id': self.run_id,
+            'stats': dict(self.stats),
+            'jobs': self.jobs,
+            'section_updates': dict(self.section_updates),
+            'finders': {name: {'calls': self.finder_calls[name],
+                               'seconds': self.finder_seconds[name]}
+                        for name in self.finder_calls},
+            'solr': {'requests': len(self.solr_seconds),
+                     'errors': len(self.solr_errors),
+                     'seconds': sum(self.solr_seconds),
+                     'max_seconds': max(self.solr_seconds) if self.solr_seconds else None},
+            'stages': self.instrumentation.summary(),
+        }
+
+        if self.keep_users:
+            summary['job_ids'] = sorted(self.job_ids)
+
+        return summary
+
+    def as_dict(self):
+        results = self.summary()
+
+        if self.keep_users:
+            results['users'] = self.users
+
+        return results
+
+    def finish(self):
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as jsonl:
+                jsonl.write(json.dumps({'summary': self.summary()}, default=json_default) + '\n')
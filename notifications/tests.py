@@ -1,3 +1,187 @@
-from django.test import TestCase
+import pickle
+from collections import OrderedDict
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import requests
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from notifications import instrumentation
+from notifications.digests import Digest
+from notifications.models import BillSearchSubscription, NotificationChange, SubscriptionWatermark
+from notifications.management.commands import send_notifications, consume_notification_changes
+
+
+class DigestTest(TestCase):
+
+    def subscriptions(self, user, **subscription_ids):
+        row = {
+            'user_id': user.id,
+            'user_email': user.email,
+            'bill_action_ids': None,
+            'bill_search_params': None,
+            'committee_action_ids': None,
+            'committee_event_ids': None,
+            'person_ids': None,
+            'event_subscription': False,
+        }
+        row.update(subscription_ids)
+
+        return row
+
+    def test_digest_starts_empty_for_each_user(self):
+        # The second user follows no bills, so none of the first user's bill
+        # action updates may carry over into their digest.
+
+        first = User.objects.create(username='first', email='first@example.com')
+        second = User.objects.create(username='second', email='second@example.com')
+
+        command = send_notifications.Command(stdout=StringIO())
+        command.start_run({
+            'users': 'all',
+            'batch': False,
+            'shared_payload': False,
+            'workers': 1,
+            'fetch_size': 100,
+            'incremental': False,
+            'run_id': None,
+            'results_jsonl': None,
+            'instrument': False,
+        })
+
+        command.bill_action_index = {
+            'ocd-bill/1': ({'slug': 'bill-1', 'identifier': 'B 1', 'description': 'A bill'},
+                           {'description': 'Introduced', 'date': date(2017, 1, 1)}),
+        }
+        command.bill_search_index = {}
+        command.committee_action_index = {
+            'ocd-organization/1': {'name': 'Finance', 'slug': 'finance', 'bills': []},
+        }
+        command.committee_event_index = {}
+        command.person_index = {}
+
+        subscribed_users = [
+            self.subscriptions(first, bill_action_ids=['ocd-bill/1']),
+            self.subscriptions(second, committee_action_ids=['ocd-organization/1']),
+        ]
+
+        queued = []
+
+        def delay(digest):
+            queued.append(digest)
+            return mock.Mock(id='job-{}'.format(len(queued)))
+
+        with mock.patch.object(command, 'find_subscribed_users', return_value=subscribed_users), \
+                mock.patch.object(send_notifications.send_notification_email, 'delay', side_effect=delay):
+            command.send_shard()
+
+        self.assertEqual([d.user_id for d in queued], [first.id, second.id])
+        self.assertEqual(len(queued[0].bill_action_updates), 1)
+        self.assertEqual(len(queued[1].committee_action_updates), 1)
+        self.assertFalse(queued[1].bill_action_updates)
+
+    def test_digest_survives_pickling(self):
+        digest = Digest(1,
+                        'user@example.com',
+                        delivery=('run', 'hash'),
+                        person_updates=[{'ocd-person/1': {'slug': 'someone'}}])
+
+        loaded = pickle.loads(pickle.dumps(digest))
+
+        self.assertEqual(loaded.user_id, 1)
+        self.assertEqual(loaded.user_email, 'user@example.com')
+        self.assertEqual(loaded.delivery, ('run', 'hash'))
+        self.assertEqual(loaded.sections(), digest.sections())
+        self.assertEqual(loaded.filled_sections, ('person_updates',))
+
+    def test_digest_loads_state_from_other_slots(self):
+        # As a job queued by a version with a slot this one lacks, and
+        # without sections this one added, would be pickled.
+        digest = Digest.__new__(Digest)
+        digest.__setstate__({
+            'user_id': 1,
+            'user_email': 'user@example.com',
+            'retired': True,
+            'person_updates': [{'ocd-person/1': {'slug': 'someone'}}],
+        })
+
+        self.assertEqual(digest.user_id, 1)
+        self.assertIsNone(digest.delivery)
+        self.assertEqual(digest.new_events, ())
+        self.assertEqual(digest.filled_sections, ('person_updates',))
+
+
+@override_settings(NOTIFICATIONS_INSTRUMENTATION='notifications.instrumentation.RecordingInstrumentation')
+@mock.patch.object(instrumentation, '_instrumentation', None)
+class InstrumentationTest(TestCase):
+
+    def test_debug_cursor_put_back(self):
+        force_debug_cursor = connection.force_debug_cursor
+
+        self.assertTrue(instrumentation.get_instrumentation().recording)
+        self.assertEqual(connection.force_debug_cursor, force_debug_cursor)
+
+        command = send_notifications.Command(stdout=StringIO())
+        command.start_run({'results_jsonl': None})
+
+        self.assertTrue(connection.force_debug_cursor)
+
+        command.instrumentation.close()
+
+        self.assertEqual(connection.force_debug_cursor, force_debug_cursor)
+
+
+def find_new_bills(self):
+    return OrderedDict([
+        ('ocd-bill/1', {'slug': 'bill-1', 'identifier': 'B 1', 'description': 'A bill'}),
+    ])
+
+
+@mock.patch.object(send_notifications, 'haystack_url', 'http://solr.invalid/solr')
+@mock.patch.object(send_notifications.Command, 'find_new_bills', find_new_bills)
+@mock.patch.object(requests.Session, 'post', side_effect=requests.ConnectionError('Solr is down'))
+@mock.patch.object(send_notifications.send_notification_email, 'delay')
+class SolrFailureTest(TestCase):
+    # A window whose saved searches could not be run must not count as sent.
+
+    def setUp(self):
+        self.user = User.objects.create(username='searcher', email='searcher@example.com')
+
+        BillSearchSubscription.objects.create(user=self.user,
+                                              search_params={'term': 'zoning', 'facets': {}})
+
+    def test_watermark_kept(self, delay, post):
+        sent_until = timezone.now() - timedelta(hours=1)
+        SubscriptionWatermark.objects.create(user=self.user, sent_until=sent_until)
+
+        call_command('send_notifications', incremental=True, stdout=StringIO(), stderr=StringIO())
+
+        self.assertTrue(post.called)
+        self.assertEqual(SubscriptionWatermark.objects.get(user=self.user).sent_until, sent_until)
+
+    def test_outbox_kept(self, delay, post):
+        NotificationChange.objects.create(source='new_bill', object_id='ocd-bill/1')
+
+        command = consume_notification_changes.Command(stdout=StringIO(), stderr=StringIO())
+        command.consume_changes({
+            'users': 'all',
+            'batch': False,
+            'shared_payload': False,
+            'workers': 1,
+            'fetch_size': 100,
+            'incremental': False,
+            'run_id': None,
+            'results_jsonl': None,
+            'instrument': False,
+            'changes_per_run': 100,
+            'verbosity': 1,
+        })
+
+        self.assertTrue(post.called)
+        self.assertEqual(NotificationChange.objects.filter(object_id='ocd-bill/1').count(), 1)
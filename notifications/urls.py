@@ -8,7 +8,7 @@ from notifications.views import notifications_login, notifications_logout, \
     bill_unsubscribe, committee_events_subscribe, committee_events_unsubscribe, \
     committee_actions_subscribe, committee_actions_unsubscribe, search_check_subscription, \
     search_subscribe, search_unsubscribe, events_subscribe, events_unsubscribe, \
-    send_notifications
+    send_notifications, send_notifications_status, bulk_subscriptions, subscription_status
 
 import django_rq
 
@@ -43,12 +43,16 @@ urlpatterns = [
     url(r'^search_check_subscription/$', search_check_subscription, name='search_check_subscription'),
     url(r'^search_subscribe/$', search_subscribe, name='search_subscribe'),
     url(r'^search_unsubscribe/(?P<subscription_id>[^/]+)/$', search_unsubscribe, name='search_unsubscribe'),
+    url(r'^subscriptions/bulk/$', bulk_subscriptions, name='bulk_subscriptions'),
+    url(r'^subscriptions/status/$', never_cache(subscription_status), name='subscription_status'),
     url(r'^events/subscribe/$',
         events_subscribe, name='events_subscribe'),
     url(r'^events/unsubscribe/$',
         events_unsubscribe, name='events_unsubscribe'),
     url(r'^send-notifications/$',
         send_notifications, name='send-notifications'),
+    url(r'^send-notifications/(?P<job_id>[^/]+)/$',
+        send_notifications_status, name='send-notifications-status'),
     # django-rq: https://github.com/ui/django-rq
     url(r'^django-rq/', include('django_rq.urls')),
 
@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from django.template.loader import get_template
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
@@ -27,3 +30,20 @@ def send_signup_email(user, host, redirect):
 
     msg.attach_alternative(html_content, 'text/html')
     msg.send()
+
+def canonical_search(search_params):
+    # Canonical form of a saved bill search, so that searches differing only
+    # in whitespace or the order of their facets compare equal.
+
+    term = (search_params.get('term') or '').strip()
+
+    facets = {facet: sorted(values)
+              for facet, values in (search_params.get('facets') or {}).items()
+              if values}
+
+    return json.dumps({'term': term, 'facets': facets}, sort_keys=True)
+
+def search_hash(search_params):
+    # canonical_search hashed to a fixed width, for storing and indexing as
+    # BillSearchSubscription.search_key.
+    return hashlib.sha1(canonical_search(search_params).encode('utf-8')).hexdigest()
@@ -4,11 +4,12 @@ import pytz
 import sys
 import random
 import hashlib
+from collections import namedtuple
 
-from io import StringIO
+import django_rq
 
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseNotAllowed
 from django.conf import settings
 from django import forms
 from django.utils import timezone
@@ -17,7 +18,6 @@ from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import EmailMessage
 from django.core.cache import cache
-from django.core import management
 
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
@@ -33,18 +33,58 @@ from django.template.loader import get_template
 from django.template import Context
 
 from django.db.models import Q
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
 
 from councilmatic_core.models import Bill, Organization, Person, Event
 from notifications.models import PersonSubscription, BillActionSubscription, \
     CommitteeActionSubscription, CommitteeEventSubscription, \
-    BillSearchSubscription, EventsSubscription, SubscriptionProfile
+    BillSearchSubscription, EventsSubscription, SubscriptionProfile, \
+    subscriptions_cache_key, subscription_status_cache_key, forget_subscriptions, \
+    index_subscribers, unindex_subscribers
 
-from notifications.utils import send_signup_email
+from notifications.utils import send_signup_email, search_hash
+from notifications.management.commands.send_notifications import send_user_notifications
 
 
 app_timezone = pytz.timezone(settings.TIME_ZONE)
 
+subscriptions_ttl = getattr(settings, 'NOTIFICATIONS_SUBSCRIPTIONS_TTL', 60 * 15)
+
+# The lists on the subscriptions page, with what each subscription follows.
+SUBSCRIPTION_LISTS = (
+    ('person_subscriptions', PersonSubscription, 'person'),
+    ('committee_action_subscriptions', CommitteeActionSubscription, 'committee'),
+    ('committee_event_subscriptions', CommitteeEventSubscription, 'committee'),
+    ('bill_search_subscriptions', BillSearchSubscription, None),
+    ('bill_action_subscriptions', BillActionSubscription, 'bill'),
+    ('events_subscriptions', EventsSubscription, None),
+)
+
+# What the subscriptions page shows of a subscription, and of the person,
+# committee or bill it follows. Cached in place of model instances, so the
+# cache holds no more than the page needs. Names are only as fresh as the
+# cache, which is why it expires after NOTIFICATIONS_SUBSCRIPTIONS_TTL.
+SubscriptionRow = namedtuple('SubscriptionRow', ['id', 'search_params', 'person', 'committee', 'bill'])
+
+
+class FollowedEntity(namedtuple('FollowedEntity', ['slug', 'name', 'title'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.title
+
+# What each type of operation accepted by bulk_subscriptions subscribes to:
+# the model looked up by slug, the subscription model, and the field linking
+# the two.
+BULK_SUBSCRIPTIONS = {
+    'person': (Person, PersonSubscription, 'person'),
+    'bill': (Bill, BillActionSubscription, 'bill'),
+    'committee_actions': (Organization, CommitteeActionSubscription, 'committee'),
+    'committee_events': (Organization, CommitteeEventSubscription, 'committee'),
+}
+
+bulk_subscriptions_limit = getattr(settings, 'NOTIFICATIONS_BULK_SUBSCRIPTIONS_LIMIT', 1000)
+
 class CouncilmaticUserCreationForm(UserCreationForm):
     email = forms.EmailField(label="Email address", required=True,
         help_text="Required.")
@@ -190,22 +230,72 @@ def notifications_logout(request):
 def notifications_account_settings(request):
     return HttpResponse('notifications_account_settings')
 
+def subscription_counts(user_id):
+    # How many of each kind of subscription a user has, in one query.
+
+    counts = ' UNION ALL '.join(
+        'SELECT %s, COUNT(*) FROM {} WHERE user_id = %s'.format(model._meta.db_table)
+        for name, model, related in SUBSCRIPTION_LISTS
+    )
+
+    args = []
+    for name, model, related in SUBSCRIPTION_LISTS:
+        args.extend([name, user_id])
+
+    cursor = connection.cursor()
+    cursor.execute(counts, args)
+
+    return dict(cursor.fetchall())
+
+def subscription_row(subscription, related):
+    followed = {'person': None, 'committee': None, 'bill': None}
+
+    if related:
+        entity = getattr(subscription, related)
+        followed[related] = FollowedEntity(entity.slug, getattr(entity, 'name', ''), str(entity))
+
+    return SubscriptionRow(subscription.id, getattr(subscription, 'search_params', None), **followed)
+
+def subscriptions_context(user):
+    # A user's subscriptions, with what they follow, as the subscriptions page
+    # shows them. Cached until any of them change, or the cache expires. Kinds
+    # the user has none of are not queried for at all, which for most users
+    # leaves the count and one or two loads.
+
+    key = subscriptions_cache_key(user.id)
+    context = cache.get(key)
+
+    if context is None:
+        counts = subscription_counts(user.id)
+        context = {}
+
+        for name, model, related in SUBSCRIPTION_LISTS:
+            subscriptions = []
+
+            if counts[name]:
+                subscriptions = model.objects.filter(user=user)
+
+                if related:
+                    subscriptions = subscriptions.select_related(related)
+
+                subscriptions = [subscription_row(s, related) for s in subscriptions]
+
+            context[name] = subscriptions
+
+        cache.set(key, context, subscriptions_ttl)
+
+    return context
+
 class SubscriptionsManageView(LoginRequiredMixin, TemplateView):
     template_name = 'subscriptions_manage.html'
 
     def get_context_data(self, *args, **kwargs):
         context = super(SubscriptionsManageView, self).get_context_data(*args, **kwargs)
 
-        context['person_subscriptions'] = self.request.user.personsubscriptions.all()
-        context['committee_action_subscriptions'] = self.request.user.committeeactionsubscriptions.all()
-        context['committee_event_subscriptions'] = self.request.user.committeeeventsubscriptions.all()
-        context['bill_search_subscriptions'] = self.request.user.billsearchsubscriptions.all()
-        context['bill_action_subscriptions'] = self.request.user.billactionsubscriptions.all()
-        context['events_subscriptions'] = self.request.user.eventssubscriptions.all()
+        subscriptions = subscriptions_context(self.request.user)
+        context.update(subscriptions)
 
-        obj_copy = context.copy()
-        del obj_copy['view']
-        if any([len(s) != 0 for s in obj_copy.values()]):
+        if any(subscriptions.values()):
             context['subscriptions'] = 'Yes, subscriptions.'
         else:
             context['subscriptions'] = None
@@ -217,8 +307,6 @@ def bill_subscribe(request, slug):
     bill = Bill.objects.get(slug=slug)
     (bill_action_subscription, created) = BillActionSubscription.objects.get_or_create(user=request.user, bill=bill)
 
-    cache.delete('subscriptions_manage')
-
     return HttpResponse('Subscribed to bill %s.' % str(bill))
 
 @login_required(login_url='/login/')
@@ -301,13 +389,165 @@ def committee_actions_unsubscribe(request, slug):
 
     return HttpResponse('Unsubscribed from actions of %s.' % str(committee))
 
+def json_response(content, status=200):
+    return HttpResponse(json.dumps(content), content_type='application/json', status=status)
+
+@login_required(login_url='/login/')
+def bulk_subscriptions(request):
+    # Applies a list of operations, given as a JSON body of the form
+    #
+    #   {"operations": [{"type": "bill", "slug": "...", "action": "subscribe"}, ...]}
+    #
+    # where type is one of BULK_SUBSCRIPTIONS and action is subscribe or
+    # unsubscribe. Operations are applied in order, all in one transaction,
+    # and each gets a result: subscribed, unsubscribed, already subscribed,
+    # not subscribed, not found or invalid.
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        operations = json.loads(request.body.decode('utf-8'))['operations']
+    except (ValueError, KeyError, TypeError):
+        return json_response({'status': 'error', 'message': 'Expected a JSON object with a list of operations.'}, status=400)
+
+    if not isinstance(operations, list):
+        return json_response({'status': 'error', 'message': 'Expected a JSON object with a list of operations.'}, status=400)
+
+    if len(operations) > bulk_subscriptions_limit:
+        return json_response({'status': 'error', 'message': 'At most {} operations at a time.'.format(bulk_subscriptions_limit)}, status=400)
+
+    results = []
+    slugs = {subscription_type: set() for subscription_type in BULK_SUBSCRIPTIONS}
+
+    for operation in operations:
+        if not isinstance(operation, dict):
+            operation = {}
+
+        result = {'type': operation.get('type'),
+                  'slug': operation.get('slug'),
+                  'action': operation.get('action')}
+
+        if result['type'] not in BULK_SUBSCRIPTIONS \
+                or result['action'] not in ('subscribe', 'unsubscribe') \
+                or not isinstance(result['slug'], str):
+            result['result'] = 'invalid'
+        else:
+            slugs[result['type']].add(result['slug'])
+
+        results.append(result)
+
+    try:
+        with transaction.atomic():
+            for subscription_type, (entity_model, model, field) in BULK_SUBSCRIPTIONS.items():
+                if not slugs[subscription_type]:
+                    continue
+
+                entity_ids = dict(entity_model.objects.filter(slug__in=slugs[subscription_type])
+                                                      .values_list('slug', 'pk'))
+
+                column = '{}_id'.format(field)
+                existing = set(model.objects.filter(user=request.user,
+                                                    **{'{}__in'.format(column): entity_ids.values()})
+                                            .values_list(column, flat=True))
+
+                # Operations on the same entity are played through in order, and
+                # only where each one ends up is written.
+                subscribed = set(existing)
+
+                for result in results:
+                    if result['type'] != subscription_type or 'result' in result:
+                        continue
+
+                    entity_id = entity_ids.get(result['slug'])
+
+                    if entity_id is None:
+                        result['result'] = 'not found'
+                    elif result['action'] == 'subscribe':
+                        result['result'] = 'already subscribed' if entity_id in subscribed else 'subscribed'
+                        subscribed.add(entity_id)
+                    else:
+                        result['result'] = 'unsubscribed' if entity_id in subscribed else 'not subscribed'
+                        subscribed.discard(entity_id)
+
+                created = [model(user=request.user, **{column: entity_id})
+                           for entity_id in subscribed - existing]
+                deleted = list(existing - subscribed)
+
+                if created:
+                    model.objects.bulk_create(created)
+                    index_subscribers(model, created)
+
+                if deleted:
+                    # Deleted in one statement, rather than one by one as
+                    # QuerySet.delete() would to send post_delete.
+                    cursor = connection.cursor()
+                    cursor.execute('DELETE FROM {0} WHERE user_id = %s AND {1} = ANY(%s)'.format(model._meta.db_table, column),
+                                   [request.user.id, deleted])
+
+                    unindex_subscribers(model, request.user.id, deleted)
+
+    except IntegrityError:
+        # Another request subscribed the user to one of the same entities
+        # meanwhile. Nothing was applied.
+        return json_response({'status': 'error', 'message': 'Subscriptions changed during the update. Try again.'}, status=409)
+
+    forget_subscriptions(request.user.id)
+
+    return json_response({'status': 'ok', 'results': results})
+
+@login_required(login_url='/login/')
+def subscription_status(request):
+    # Whether the user follows each of the entities given by slug, one query
+    # string parameter per type of BULK_SUBSCRIPTIONS, e.g.
+    #
+    #   ?bill=slug-1&bill=slug-2&person=slug-3
+    #
+    # The answers are cached for the user as they are found, and forgotten
+    # whenever their subscriptions change, so only slugs not asked about
+    # since then are queried, with one query per type.
+
+    slugs = {subscription_type: set(request.GET.getlist(subscription_type))
+             for subscription_type in BULK_SUBSCRIPTIONS}
+
+    if sum(len(s) for s in slugs.values()) > bulk_subscriptions_limit:
+        return json_response({'status': 'error', 'message': 'At most {} entities at a time.'.format(bulk_subscriptions_limit)}, status=400)
+
+    key = subscription_status_cache_key(request.user.id)
+    known = cache.get(key) or {}
+    found_new = False
+
+    for subscription_type, (entity_model, model, field) in BULK_SUBSCRIPTIONS.items():
+        known_for_type = known.setdefault(subscription_type, {})
+        unknown = slugs[subscription_type] - set(known_for_type)
+
+        if not unknown:
+            continue
+
+        slug_field = '{}__slug'.format(field)
+        followed = set(model.objects.filter(user=request.user,
+                                            **{'{}__in'.format(slug_field): unknown})
+                                    .values_list(slug_field, flat=True))
+
+        known_for_type.update((slug, slug in followed) for slug in unknown)
+        found_new = True
+
+    if found_new:
+        cache.set(key, known, subscriptions_ttl)
+
+    status = {subscription_type: {slug: known[subscription_type][slug] for slug in slugs[subscription_type]}
+              for subscription_type in BULK_SUBSCRIPTIONS}
+
+    return json_response({'status': 'ok', 'subscriptions': status})
+
 @login_required(login_url='/login/')
 def search_subscribe(request):
     q = request.POST.get('query')
     selected_facets = request.POST.get('selected_facets')
     search_params = {'term': q, 'facets': json.loads(selected_facets)}
     (bss, created) = BillSearchSubscription.objects.get_or_create(user=request.user,
-                                                                  search_params=search_params)
+                                                                  search_key=search_hash(search_params),
+                                                                  defaults={'search_params': search_params})
 
     return HttpResponse('Subscribed to search for: %s.' % q)
 
@@ -331,11 +571,8 @@ def search_check_subscription(request):
     selected_facets_json = json.loads(selected_facets)
     search_params = {'term': q, 'facets': selected_facets_json}
 
-    try:
-        bss = BillSearchSubscription.objects.get(user=request.user,
-                                                 search_params__exact=search_params)
-
-    except ObjectDoesNotExist:
+    if not BillSearchSubscription.objects.filter(user=request.user,
+                                                 search_key=search_hash(search_params)).exists():
         response = HttpResponse('This bill search subscription does not exist.')
         response.status_code = 500
         return response
@@ -364,17 +601,30 @@ def events_unsubscribe(request):
 
 @login_required(login_url='/login/')
 def send_notifications(request):
-    notify_output = StringIO()
-    management.call_command('send_notifications', users=request.user.username, stdout=notify_output)
-    results = notify_output.getvalue()
+    # Finding a user's updates can take a while, so it is done by a worker.
+    # Poll the status URL for the result.
+    job = send_user_notifications.delay(request.user.username)
 
     timestamp = json.dumps(datetime.datetime.now().isoformat())
+    status_url = reverse('send-notifications-status', args=[job.id])
 
-    # TODO: Make this more refined, using json.loads(), to show count of each subscription.
-    if 'no email' in results:
-        return HttpResponse(json.dumps({'status': 'ok', 'email_sent': 'false', 'date': timestamp}), content_type='application/json')
-    else:
-        return HttpResponse(json.dumps({'status': 'ok', 'email_sent': 'true', 'date': timestamp}), content_type='application/json')
+    return HttpResponse(json.dumps({'status': 'ok', 'job_id': job.id, 'status_url': status_url, 'date': timestamp}), content_type='application/json')
+
+@login_required(login_url='/login/')
+def send_notifications_status(request, job_id):
+    job = django_rq.get_queue().fetch_job(job_id)
+
+    if job is None or job.func_name != send_user_notifications.__module__ + '.send_user_notifications' \
+            or list(job.args) != [request.user.username]:
+        raise Http404
+
+    status = {'status': 'ok', 'job_id': job.id, 'job_status': job.get_status()}
+
+    if job.is_finished:
+        status['email_sent'] = 'true' if job.result['email_sent'] else 'false'
+        status['sections'] = job.result['sections']
+
+    return HttpResponse(json.dumps(status), content_type='application/json')
 # The function worker_handle_notification_email() is invoked when the 'notifications_emails' queue (notification_emails_queue)
 # is woken up.
 